@@ -1,81 +1,177 @@
 import pygame as pg
 import os
-from os.path import join 
-from pytmx.util_pygame import load_pygame
-from setup import TILE_SIZE, BASE_PATH
+from os.path import join
+from time import perf_counter
+from mapcache import load_map
+from particles import particle_atlas
+from audio import audio
+from setup import BASE_PATH, DEBUG
 
 '''All of the asset management is handeled in this file'''
 
-pg.init()
-pg.mixer.init()
-
-
-
 # Images ----------------------------------------------------------
 
 IMAGE_PATHS = {
     "bee"       : [(join(BASE_PATH, 'images', 'enemies', 'bee', f"{image}.png")) for image in range (2)],
     "worm"      : [(join(BASE_PATH, 'images', 'enemies', 'worm', f"{image}.png")) for image in range (2)],
-    "bullet"    : pg.image.load(join(BASE_PATH, 'images', 'gun', 'bullet.png')),
-    "fire"      : pg.image.load(join(BASE_PATH, 'images', 'gun', 'fire.png')),
+    "bullet"    : join(BASE_PATH, 'images', 'gun', 'bullet.png'),
+    "fire"      : join(BASE_PATH, 'images', 'gun', 'fire.png'),
     "player"    : [(join(BASE_PATH, 'images', 'player', f"{image}.png")) for image in range (3)],
     "map"       : (join(BASE_PATH, 'data', 'maps', 'world.tmx'))
 }
 
+# Levels in the order they are played, after the last one the first one comes around again
+LEVEL_PATHS = [
+    IMAGE_PATHS['map'],
+]
+
 
 # Audio -----------------------------------------------------------
 
 AUDIO_PATHS = {
-    "shoot_sound"   : pg.mixer.Sound(join(BASE_PATH,'audio', 'shoot.wav')),
-    "impact_sound"  : pg.mixer.Sound(join(BASE_PATH,'audio', 'impact.ogg')),
-    "music"         : pg.mixer.Sound(join(BASE_PATH,'audio', 'music.wav')),   
+    "shoot_sound"   : join(BASE_PATH,'audio', 'shoot.wav'),
+    "impact_sound"  : join(BASE_PATH,'audio', 'impact.ogg'),
+    "music"         : join(BASE_PATH,'audio', 'music.wav'),
+}
+# Category and volume of every sound effect. Sounds are only decoded once the mixer is running, and never
+# for headless games
+SOUNDS = {
+    "shoot_sound"   : ('weapon', 0.3),
+    "impact_sound"  : ('impact', 0.3),
 }
 
 
+class AssetManager:
+    '''
+    Nothing is read from disk until it is first asked for, and every asset is cached by its path so
+    asking again hands back the same object. Each request bumps a reference count and the asset is
+    dropped once every holder has released it. Images are always converted to the display format,
+    so the display has to exist before the first image is requested.
+    '''
+    def __init__(self):
+        # path: [asset, reference count]
+        self.cache = {}
+        # path: seconds it took to load
+        self.load_times = {}
+
+    def acquire(self, path: str, loader):
+        entry = self.cache.get(path)
+        if entry is None:
+            start = perf_counter()
+            entry = self.cache[path] = [loader(path), 0]
+            self.load_times[path] = perf_counter() - start
+        entry[1] += 1
+        return entry[0]
+
+    def release(self, path: str):
+        entry = self.cache.get(path)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del self.cache[path]
+
+    def references(self, path: str) -> int:
+        entry = self.cache.get(path)
+        return entry[1] if entry else 0
+
+    def image(self, path: str) -> pg.Surface:
+        return self.acquire(path, lambda path: pg.image.load(path).convert_alpha())
+
+    def sound(self, path: str) -> pg.mixer.Sound:
+        return self.acquire(path, pg.mixer.Sound)
+
+    def map(self, path: str, compiled = None):
+        '''A map already loaded on a loader thread is handed in as compiled, and only converted here'''
+        return self.acquire(path, lambda path: (compiled or load_map(path)).convert())
+
+    def report(self) -> list:
+        '''Load time of every asset in milliseconds, slowest first'''
+        return sorted(((path, seconds * 1000) for path, seconds in self.load_times.items()),
+                      key = lambda item: item[1], reverse = True)
+
+asset_manager = AssetManager()
+
+
+class FrameCache:
+    '''
+    Flipping a frame or building its mask allocates a new surface, so every variant is made once here.
+    Each list is indexed with the sprite's flip flag: [0] faces right and [1] faces left. Alongside the
+    frames we keep their collision masks and the white silhouettes enemies flash when they are destroyed.
+    '''
+    def __init__(self, frames: list):
+        self.images = (frames, [pg.transform.flip(frame, True, False) for frame in frames])
+        self.masks = tuple([pg.mask.from_surface(frame) for frame in images] for images in self.images)
+        self.silhouettes = tuple([silhouette(mask) for mask in masks] for masks in self.masks)
+
+    def __len__(self):
+        return len(self.images[0])
+
+def silhouette(mask):
+    surf = mask.to_surface()
+    surf.set_colorkey('black')
+    return surf
+
 def load_assets(Game):
-    # Load player 
-    Game.player_frames = [pg.image.load(path).convert_alpha() for path in IMAGE_PATHS['player']]
+    # Every path is remembered so unload_assets can hand it back to the manager
+    Game.asset_paths = []
+    def acquire(loader, path):
+        Game.asset_paths.append(path)
+        return loader(path)
+
+    # Load player
+    Game.player_frames = FrameCache([acquire(asset_manager.image, path) for path in IMAGE_PATHS['player']])
     # Load enemies
-    Game.bee_frames = [pg.image.load(path).convert_alpha() for path in IMAGE_PATHS['bee']]
-    Game.worm_frames = [pg.image.load(path).convert_alpha() for path in IMAGE_PATHS['worm']]
-    
-    # Load audio
+    Game.bee_frames = FrameCache([acquire(asset_manager.image, path) for path in IMAGE_PATHS['bee']])
+    Game.worm_frames = FrameCache([acquire(asset_manager.image, path) for path in IMAGE_PATHS['worm']])
+
+    # Load audio. Music is streamed from disk by pg.mixer.music instead of being decoded into memory
     Game.music = AUDIO_PATHS['music']
-    Game.impact_sound = AUDIO_PATHS['impact_sound']
-    Game.shoot_sound = AUDIO_PATHS['shoot_sound']
+    if not Game.headless:
+        for name, (category, volume) in SOUNDS.items():
+            audio.add(name, acquire(asset_manager.sound, AUDIO_PATHS[name]), category, volume)
 
-    # Load map
-    Game.map = load_pygame(IMAGE_PATHS['map'])
-    Game.map_width = Game.map.width * TILE_SIZE
-    Game.map_height = Game.map.height * TILE_SIZE
     # Load weapon
-    Game.bullet_png = IMAGE_PATHS['bullet']
-    Game.fire_png =  IMAGE_PATHS['fire']
-    pg.display.set_icon(Game.player_frames[1])        
-    return entity(Game)
-
-def entity(Game) -> tuple:
-    for entity in Game.map.get_layer_by_name('Entities'):
+    Game.bullet_png = acquire(asset_manager.image, IMAGE_PATHS['bullet'])
+    Game.fire_png = acquire(asset_manager.image, IMAGE_PATHS['fire'])
+    Game.bullet_frames = FrameCache([Game.bullet_png])
+    # Effects are particles, all drawn from one atlas
+    Game.particle_atlas = particle_atlas(Game.fire_png)
+    pg.display.set_icon(Game.player_frames.images[0][1])
+
+    if DEBUG:
+        for path, ms in asset_manager.report():
+            print(f"{ms:8.2f} ms  {os.path.relpath(path, BASE_PATH)}")
+
+def unload_assets(Game):
+    '''Hands everything load_assets acquired back to the manager, called once the game is closed'''
+    if not Game.headless:
+        audio.clear()
+    for path in Game.asset_paths:
+        asset_manager.release(path)
+    Game.asset_paths = []
+
+def entity(Level) -> tuple:
+    for entity in Level.map.objects('Entities'):
         # Grabs the starting position of the player entity in the tile map
         if entity.name == 'Player':
             player_start_pos = (entity.x, entity.y)
         elif entity.name == 'Worm':
-            Game.worm_spawn_positions.append((entity.x, entity.y))
+            Level.worm_spawn_positions.append((entity.x, entity.y))
         # Bee spawn positions will be random
 
     return player_start_pos
 
 def shoot_bullet_sound():
-    shoot_sound = AUDIO_PATHS['shoot_sound']
-    shoot_sound.play()
-    shoot_sound.set_volume(0.3)
+    audio.play('shoot_sound')
 
 def impact_sound():
-    impact_sound = AUDIO_PATHS['impact_sound']
-    impact_sound.play()
-    impact_sound.set_volume(0.3)
+    audio.play('impact_sound')
 
 def music(self):
-    self.music.play(loops = -1)
-    self.music.set_volume(0.2)
-
+    # The music file is optional, without it the game just plays without music
+    if not os.path.exists(self.music):
+        return
+    pg.mixer.music.load(self.music)
+    pg.mixer.music.set_volume(0.2)
+    pg.mixer.music.play(loops = -1)
@@ -0,0 +1,99 @@
+from setup import *
+from time import perf_counter
+
+'''
+All sound effects go through one AudioManager. Every sound belongs to a category, and every category has its
+own reserved mixer channels, which are also the most voices it can play at once: a new voice in a full
+category takes over the category's oldest one, so shots can never starve impacts of channels or the other
+way around. The same sound played again within SOUND_COALESCE_MS is not started again, the voice already
+playing it gets louder instead, so a burst of hits in one frame costs one voice.
+
+A sound's volume is set once when it is added. Channels play at 1 / SOUND_COALESCE_MAX, with the sounds
+raised to match, which leaves coalescing the headroom to turn a channel up.
+'''
+# Volume of every channel whose voice hasn't been made louder
+CHANNEL_VOLUME = 1 / SOUND_COALESCE_MAX
+
+class AudioManager:
+    def __init__(self, categories = SOUND_CATEGORIES, window = SOUND_COALESCE_MS):
+        self.categories = categories
+        self.window = window
+        # name: (sound, category)
+        self.sounds = {}
+        # category: [[channel, time its voice started, sound it started with, made louder]]
+        self.groups = {}
+        # name: (voice, events merged into it)
+        self.latest = {}
+        self.events = 0
+        self.coalesced = 0
+        self.stolen = 0
+
+    def init(self):
+        '''Reserves the channels of every category, once the mixer is running'''
+        total = sum(self.categories.values())
+        pg.mixer.set_num_channels(total)
+        pg.mixer.set_reserved(total)
+        first = 0
+        for category, channels in self.categories.items():
+            self.groups[category] = group = []
+            for index in range(first, first + channels):
+                channel = pg.mixer.Channel(index)
+                channel.set_volume(CHANNEL_VOLUME)
+                group.append([channel, 0, None, False])
+            first += channels
+
+    def add(self, name: str, sound, category: str, volume: float = 1):
+        if not self.groups:
+            self.init()
+        sound.set_volume(min(1, volume / CHANNEL_VOLUME))
+        self.sounds[name] = (sound, category)
+
+    def clear(self):
+        pg.mixer.stop()
+        # The channels are reserved and set up again by the next add(), the mixer may have been restarted
+        self.sounds, self.groups, self.latest = {}, {}, {}
+
+    def play(self, name: str):
+        if name not in self.sounds:
+            return
+        sound, category = self.sounds[name]
+        now = perf_counter() * 1000
+        self.events += 1
+
+        latest = self.latest.get(name)
+        if latest:
+            voice, merged = latest
+            channel, started, playing, _ = voice
+            if now - started < self.window and playing is sound and channel.get_sound() is sound:
+                merged += 1
+                self.latest[name] = (voice, merged)
+                channel.set_volume(CHANNEL_VOLUME * min(1 + SOUND_COALESCE_GAIN * merged, SOUND_COALESCE_MAX))
+                voice[3] = True
+                self.coalesced += 1
+                return
+
+        voice = self.voice(category)
+        channel = voice[0]
+        # A channel that was made louder for its last voice is turned back down
+        if voice[3]:
+            channel.set_volume(CHANNEL_VOLUME)
+        channel.play(sound)
+        voice[1:] = now, sound, False
+        self.latest[name] = (voice, 0)
+
+    def voice(self, category: str) -> list:
+        '''A free channel of the category, or the one that has played the longest'''
+        group = self.groups[category]
+        for voice in group:
+            if not voice[0].get_busy():
+                return voice
+        self.stolen += 1
+        return min(group, key=lambda voice: voice[1])
+
+    def voices(self) -> int:
+        return sum(voice[0].get_busy() for group in self.groups.values() for voice in group)
+
+    def stats(self) -> dict:
+        return {'events': self.events, 'coalesced': self.coalesced, 'stolen': self.stolen, 'voices': self.voices()}
+
+audio = AudioManager()
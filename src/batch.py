@@ -0,0 +1,228 @@
+import multiprocessing as mp
+import os
+import time
+import traceback
+from argparse import ArgumentParser
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+
+'''
+Runs many headless games at once for play-testing and balance tuning. The games are spread over a pool of
+worker processes, and every call to step() advances all of them in lockstep with one row of inputs per game.
+Inputs and observations live in one block of shared memory that every process maps as NumPy arrays, so the
+pipes to the workers only ever carry a tiny command, and nothing is pickled per game or per step.
+
+    with BatchRunner(64) as runner:
+        observations = runner.step(inputs)     # inputs: (64, 4) left, right, jump, shoot
+
+    python src/batch.py --games 64 --steps 500
+'''
+
+def layout(n_games: int, max_enemies: int) -> list:
+    '''(name, shape, dtype, offset) of every array in the shared block, the same in every process'''
+    fields = [
+        ('inputs',      (n_games, 4),               np.uint8),      # left, right, jump, shoot
+        ('player',      (n_games, 2),               np.float32),    # player center
+        ('enemies',     (n_games, max_enemies, 2),  np.float32),    # centers of the enemies nearest to the player
+        ('enemy_count', (n_games,),                 np.int32),      # rows of enemies in use
+        ('kills',       (n_games,),                 np.int32),
+        ('frames',      (n_games,),                 np.int64),      # steps since the game was started
+        ('done',        (n_games,),                 np.bool_),
+    ]
+    arrays, offset = [], 0
+    for name, shape, dtype in fields:
+        # Every array starts on a 64 byte boundary, so no two processes write to the same cache line
+        offset = -(-offset // 64) * 64
+        arrays.append((name, shape, dtype, offset))
+        offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+    return arrays
+
+def views(buffer, arrays: list) -> dict:
+    return {name: np.ndarray(shape, dtype, buffer, offset) for name, shape, dtype, offset in arrays}
+
+def block_size(arrays: list) -> int:
+    name, shape, dtype, offset = arrays[-1]
+    return offset + int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+def observe(game, index: int, arrays: dict):
+    player = game.player.rect.center
+    arrays['player'][index] = player
+    arrays['kills'][index] = game.kill_count
+    # Counted by the game itself, a game that ended mid batch stopped stepping there
+    arrays['frames'][index] = game.frame
+    arrays['done'][index] = not game.running
+
+    enemies = arrays['enemies'][index]
+    centers = np.array([sprite.rect.center for sprite in game.enemy_sprites], dtype=np.float32).reshape(-1, 2)
+    if len(centers) > len(enemies):
+        distances = ((centers - player) ** 2).sum(axis=1)
+        centers = centers[np.argpartition(distances, len(enemies))[:len(enemies)]]
+    enemies[:len(centers)] = centers
+    arrays['enemy_count'][index] = len(centers)
+
+def worker(connection, shared_name: str, n_games: int, max_enemies: int, first: int, last: int,
+           seed: int, map_path):
+    '''Owns the games first to last, and steps them whenever the runner asks'''
+    os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
+    # SDL would turn SIGTERM into a quit event, then terminate() could not stop the worker
+    os.environ['SDL_NO_SIGNAL_HANDLERS'] = '1'
+    # Imported here so the runner process never has to start pygame itself
+    from random import Random
+    from main import Game
+    from controls import Controls
+
+    # Spawned workers share the runner's resource tracker, so the block is still unlinked only once
+    shared = SharedMemory(shared_name)
+    arrays = views(shared.buf, layout(n_games, max_enemies))
+    try:
+        # Every game, and every restart of it, gets its own seed
+        seeds = Random(seed + first)
+
+        def new_game():
+            game = Game(headless=True, map_path=map_path, seed=seeds.randrange(1 << 63))
+            game.level_loader.wait()
+            return game
+
+        games = {index: new_game() for index in range(first, last)}
+        for index, game in games.items():
+            observe(game, index, arrays)
+        connection.send('ready')
+
+        while True:
+            command, frames = connection.recv()
+            if command == 'close':
+                for game in games.values():
+                    game.close()
+                break
+            for index, game in games.items():
+                # Finished games are restarted on the step after the one that reported them done
+                if command == 'reset' or not game.running:
+                    finished, game = game, new_game()
+                    games[index] = game
+                    # Closed once the new game holds the cached assets, so they are not loaded again
+                    finished.close()
+                if command == 'step':
+                    game.step(frames, Controls(*arrays['inputs'][index].astype(bool).tolist()))
+                observe(game, index, arrays)
+            connection.send('ready')
+    except Exception:
+        # The runner raises it, instead of waiting on a worker that is gone
+        connection.send(('error', traceback.format_exc()))
+    finally:
+        # The views have to go before the block can be closed
+        del arrays
+        shared.close()
+
+class BatchRunner:
+    '''
+    n_games headless games split over workers processes (one per core by default). The observation arrays
+    returned by step() and reset() are views on the shared block, so they are overwritten by the next call.
+    '''
+    def __init__(self, n_games: int, workers: int = None, seed: int = 0, map_path = None, max_enemies: int = 32):
+        # A cold map cache is compiled here once, instead of by every worker at the same time
+        from mapcache import load_map
+        from assets import IMAGE_PATHS, LEVEL_PATHS
+        for path in {map_path or IMAGE_PATHS['map'], *LEVEL_PATHS}:
+            load_map(path)
+
+        self.n_games = n_games
+        workers = max(1, min(n_games, workers or os.cpu_count() or 1))
+        arrays = layout(n_games, max_enemies)
+        self.shared = SharedMemory(create=True, size=block_size(arrays))
+        self.arrays = views(self.shared.buf, arrays)
+        self.arrays['inputs'][:] = 0
+
+        # Spawned rather than forked, a fork would copy whatever SDL state this process has
+        context = mp.get_context('spawn')
+        bounds = np.linspace(0, n_games, workers + 1).astype(int).tolist()
+        self.connections, self.processes = [], []
+        for first, last in zip(bounds, bounds[1:]):
+            parent, child = context.Pipe()
+            process = context.Process(target=worker, daemon=True,
+                                      args=(child, self.shared.name, n_games, max_enemies, first, last, seed, map_path))
+            process.start()
+            # Only the worker holds its end now, so the pipe reports EOF once the worker is gone
+            child.close()
+            self.connections.append(parent)
+            self.processes.append(process)
+        try:
+            self.wait()
+        except RuntimeError:
+            self.close()
+            raise
+
+    def wait(self):
+        '''Waits for every worker to be ready, raises RuntimeError if one of them failed or died'''
+        for connection, process in zip(self.connections, self.processes):
+            try:
+                reply = connection.recv()
+            except (EOFError, OSError):
+                process.join()
+                raise RuntimeError(f"Batch worker {process.pid} exited with code {process.exitcode}") from None
+            if reply != 'ready':
+                raise RuntimeError(f"Batch worker {process.pid} failed:\n{reply[1]}")
+
+    def command(self, command, frames = 0) -> dict:
+        for connection in self.connections:
+            try:
+                connection.send((command, frames))
+            except OSError:
+                # The worker is gone, wait() raises with its exit code
+                pass
+        self.wait()
+        return self.observations()
+
+    def observations(self) -> dict:
+        return {name: array for name, array in self.arrays.items() if name != 'inputs'}
+
+    def step(self, inputs, frames: int = 1) -> dict:
+        '''Holds each game's row of inputs for frames simulation steps, games that were done restart first'''
+        self.arrays['inputs'][:] = inputs
+        return self.command('step', frames)
+
+    def reset(self) -> dict:
+        return self.command('reset')
+
+    def close(self):
+        if self.shared is None:
+            return
+        for connection in self.connections:
+            # Workers that failed have already exited
+            try:
+                connection.send(('close', 0))
+            except OSError:
+                pass
+        for process in self.processes:
+            process.join()
+        self.arrays = None
+        self.shared.close()
+        self.shared.unlink()
+        self.shared = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def main():
+    parser = ArgumentParser(description='Steps many headless games in parallel with random inputs')
+    parser.add_argument('--games', type=int, default=16)
+    parser.add_argument('--workers', type=int, help='worker processes, one per core by default')
+    parser.add_argument('--steps', type=int, default=200)
+    parser.add_argument('--frames', type=int, default=1, help='simulation steps per batch step')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    with BatchRunner(args.games, args.workers, args.seed) as runner:
+        start = time.perf_counter()
+        for _ in range(args.steps):
+            observations = runner.step(rng.random((args.games, 4)) < 0.3, args.frames)
+        elapsed = time.perf_counter() - start
+        frames = args.games * args.steps * args.frames
+        print(f"{len(runner.processes)} workers, {args.games} games: {frames / elapsed:,.0f} simulation steps/s, "
+              f"{observations['kills'].sum()} kills, {observations['done'].sum()} done")
+
+if __name__ == '__main__':
+    main()
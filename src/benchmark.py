@@ -0,0 +1,203 @@
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+from argparse import ArgumentParser
+from random import Random
+
+# Keeps stdout clean for the JSON report
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+from main import Game
+from setup import *
+from assets import IMAGE_PATHS
+from sprites import Worm, TransparentSprite
+
+'''
+Runs the game headlessly through scripted stress scenarios and reports how long each part of a frame takes.
+Every frame is split into update (timers and sprites), collision (Game.collision) and draw (Game.draw),
+with the time spent in Player.collision reported on its own, since it runs inside the sprite update.
+
+    python src/benchmark.py --scenario all --output bench.json
+    python src/benchmark.py --bees 2000 --bullets 200 --frames 600
+'''
+
+SCENARIOS = {
+    'idle'      : {},
+    'bees'      : {'bees': 500},
+    'bullets'   : {'bullets': 300},
+    'worms'     : {'worms': 50},
+    'large-map' : {'map_repeat': 10, 'worms': 50},
+    'stress'    : {'bees': 1000, 'bullets': 300, 'worms': 50, 'map_repeat': 10},
+    'bee-hell'  : {'bees': 5000, 'bullets': 100},
+}
+
+def percentiles(samples: list) -> dict:
+    ordered = sorted(samples)
+    pick = lambda fraction: ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+    return {
+        'mean_ms' : sum(ordered) / len(ordered) * 1000,
+        'p50_ms'  : pick(0.50) * 1000,
+        'p90_ms'  : pick(0.90) * 1000,
+        'p99_ms'  : pick(0.99) * 1000,
+        'max_ms'  : ordered[-1] * 1000,
+    }
+
+def synthetic_map(repeat: int) -> str:
+    '''
+    Writes a copy of world.tmx that is repeat times as wide, with its tile layers and entities tiled
+    horizontally, and returns the path. The tileset reference is made absolute so the copy can live anywhere,
+    and the path is the same for every run so the compiled map cache is reused.
+    '''
+    source = IMAGE_PATHS['map']
+    tree = ET.parse(source)
+    root = tree.getroot()
+    width = int(root.get('width'))
+    root.set('width', str(width * repeat))
+
+    for tileset in root.iter('tileset'):
+        tileset.set('source', os.path.normpath(os.path.join(os.path.dirname(source), tileset.get('source'))))
+
+    for layer in root.iter('layer'):
+        layer.set('width', str(width * repeat))
+        data = layer.find('data')
+        rows = [row.rstrip(',') for row in data.text.split()]
+        data.text = '\n' + ',\n'.join(','.join([row] * repeat) for row in rows) + '\n'
+
+    next_id = int(root.get('nextobjectid'))
+    for group in root.iter('objectgroup'):
+        originals = [obj for obj in group.findall('object') if obj.get('name') != 'Player']
+        for copy_index in range(1, repeat):
+            for obj in originals:
+                copy = ET.SubElement(group, 'object', dict(obj.attrib))
+                copy.set('id', str(next_id))
+                copy.set('x', str(float(obj.get('x')) + copy_index * width * TILE_SIZE))
+                next_id += 1
+    root.set('nextobjectid', str(next_id))
+
+    path = join(tempfile.gettempdir(), f"platform-benchmark-x{repeat}.tmx")
+    tree.write(path, encoding='UTF-8', xml_declaration=True)
+    return path
+
+def populate(game, rng, bees = 0, bullets = 0, worms = 0):
+    '''Spawns the stress entities around the player so they are updated, collided and drawn'''
+    player_x, player_y = game.player.rect.center
+    swarm = game.bee_swarm
+    for _ in range(bees):
+        index = game.spawn_bee()
+        swarm.x[index] = rng.uniform(player_x - DISPLAY_WIDTH / 2, game.map_width)
+        swarm.y[index] = rng.uniform(100, game.map_height)
+    for _ in range(bullets):
+        game.create_bullet((player_x, rng.uniform(player_y - DISPLAY_HEIGHT / 2, player_y + DISPLAY_HEIGHT / 2)),
+                           rng.choice((-1, 1)))
+    for _ in range(worms):
+        area = rng.choice(game.level.worm_spawn_area)
+        area = TransparentSprite((area.x, area.y), area.width, area.height, RGB=(255,0,0), debug=False)
+        Worm(game.worm_frames, (rng.uniform(area.rect.left, area.rect.right - TILE_SIZE), area.rect.top), area,
+             game.platforms, game.scheduler, game.enemy_sprites, game.all_sprites)
+
+def timed(func, samples):
+    '''Wraps func so every call adds its duration to the last entry of samples'''
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        samples[-1] += time.perf_counter() - start
+        return result
+    return wrapper
+
+def run_scenario(name, frames = 600, seed = 0, bees = 0, bullets = 0, worms = 0, map_repeat = 1,
+                 trace_allocations = False) -> dict:
+    game = Game(headless=True, map_path=synthetic_map(map_repeat) if map_repeat > 1 else None, seed=seed)
+    # Stress entities are spawned up front, the spawn timer would make every run different
+    game.bee_timer.cancel()
+    # The next level is prepared on a thread, it should not compete with the measured frames
+    game.level_loader.wait()
+    populate(game, Random(seed), bees, bullets, worms)
+
+    stages = {'update': [], 'collision': [], 'player_collision': [], 'draw': [], 'frame': []}
+    game.collision = timed(game.collision, stages['collision'])
+    game.player.collision = timed(game.player.collision, stages['player_collision'])
+    allocations = []
+    gc_before = [stats['collections'] for stats in gc.get_stats()]
+    blocks_before = sys.getallocatedblocks()
+    if trace_allocations:
+        tracemalloc.start()
+
+    for _ in range(frames):
+        for samples in stages.values():
+            samples.append(0.0)
+        if trace_allocations:
+            tracemalloc.reset_peak()
+            traced_before = tracemalloc.get_traced_memory()[0]
+
+        start = time.perf_counter()
+        game.update(SIM_DT)
+        updated = time.perf_counter()
+        game.draw(1)
+        end = time.perf_counter()
+
+        if trace_allocations:
+            allocations.append(tracemalloc.get_traced_memory()[1] - traced_before)
+        # Collision is timed inside update, so it is taken back out of the update stage
+        stages['update'][-1] = updated - start - stages['collision'][-1]
+        stages['draw'][-1] = end - updated
+        stages['frame'][-1] = end - start
+
+    if trace_allocations:
+        tracemalloc.stop()
+
+    report = {
+        'scenario'      : name,
+        'parameters'    : {'frames': frames, 'seed': seed, 'bees': bees, 'bullets': bullets,
+                           'worms': worms, 'map_repeat': map_repeat},
+        'sprites'       : len(game.all_sprites),
+        'swarm'         : len(game.bee_swarm),
+        'pools'         : game.pool_stats(),
+        'timings'       : {stage: percentiles(samples) for stage, samples in stages.items()},
+        'allocations'   : {
+            'gc_collections'    : [stats['collections'] - before for stats, before in zip(gc.get_stats(), gc_before)],
+            'net_blocks'        : sys.getallocatedblocks() - blocks_before,
+        },
+    }
+    if trace_allocations:
+        report['allocations']['peak_bytes_per_frame'] = {
+            'p50': sorted(allocations)[len(allocations) // 2], 'max': max(allocations)}
+    return report
+
+def main():
+    parser = ArgumentParser(description='Headless frame time benchmark')
+    parser.add_argument('--scenario', default='custom', choices=['custom', 'all', *SCENARIOS],
+                        help='a preset scenario, all presets, or custom to use the counts below')
+    parser.add_argument('--frames', type=int, default=600)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--bees', type=int, default=0)
+    parser.add_argument('--bullets', type=int, default=0)
+    parser.add_argument('--worms', type=int, default=0)
+    parser.add_argument('--map-repeat', type=int, default=1, help='tile world.tmx this many times horizontally')
+    parser.add_argument('--trace-allocations', action='store_true', help='track per-frame allocations (slow)')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    if args.scenario == 'custom':
+        scenarios = {'custom': {'bees': args.bees, 'bullets': args.bullets, 'worms': args.worms,
+                                'map_repeat': args.map_repeat}}
+    elif args.scenario == 'all':
+        scenarios = SCENARIOS
+    else:
+        scenarios = {args.scenario: SCENARIOS[args.scenario]}
+
+    reports = [run_scenario(name, frames=args.frames, seed=args.seed, trace_allocations=args.trace_allocations,
+                            **parameters) for name, parameters in scenarios.items()]
+    results = {'python': sys.version.split()[0], 'pygame': pg.version.ver, 'results': reports}
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+from setup import *
+from math import ceil
+
+'''
+Broadphase for the dynamic sprites. Sprites are filed into a uniform grid of BROADPHASE_CELL_SIZE cells,
+so a query only looks at the sprites sharing a cell with the queried rect instead of every sprite.
+The grid is rebuilt once per step, which is cheap compared to testing every pair.
+'''
+class SpatialHash:
+    def __init__(self, cell_size = BROADPHASE_CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}
+
+    def cell_range(self, rect):
+        size = self.cell_size
+        return (range(int(rect.left // size), int(rect.right // size) + 1),
+                range(int(rect.top // size), int(rect.bottom // size) + 1))
+
+    def rebuild(self, sprites):
+        self.cells.clear()
+        for sprite in sprites:
+            cols, rows = self.cell_range(sprite.rect)
+            for row in rows:
+                for col in cols:
+                    self.cells.setdefault((col, row), []).append(sprite)
+
+    def query(self, rect) -> list:
+        '''Sprites whose rect overlaps the rect, each one only once and in insertion order'''
+        found = {}
+        cols, rows = self.cell_range(rect)
+        for row in rows:
+            for col in cols:
+                for sprite in self.cells.get((col, row), ()):
+                    if sprite not in found and sprite.rect.colliderect(rect):
+                        found[sprite] = None
+        return list(found)
+
+def swept_rect(sprite):
+    '''The area the sprite covered moving from its position at the previous step to its current one'''
+    if sprite.previous_pos is None:
+        return sprite.rect
+    return sprite.rect.union(pg.FRect(sprite.previous_pos, sprite.rect.size))
+
+def swept_mask_collide(sprite, other) -> bool:
+    '''
+    Mask test of the sprite against other at points along its path since the previous step, spaced no further
+    apart than the sprite is wide or tall, so a fast sprite can't skip over a thin one between two steps.
+    '''
+    x, y = sprite.rect.topleft
+    start_x, start_y = sprite.previous_pos or (x, y)
+    dx, dy = x - start_x, y - start_y
+    steps = max(1, ceil(max(abs(dx) / sprite.rect.width, abs(dy) / sprite.rect.height)))
+    for step in range(1, steps + 1):
+        offset = (int(start_x + dx * step / steps - other.rect.x), int(start_y + dy * step / steps - other.rect.y))
+        if other.mask.overlap(sprite.mask, offset):
+            return True
+    return False
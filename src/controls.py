@@ -0,0 +1,33 @@
+from setup import *
+from collections import namedtuple
+
+'''
+The player never reads the keyboard directly, it asks an input source for the Controls of the current step.
+Normally that is the keyboard and mouse, while headless games are driven by whatever Game.step is given.
+'''
+Controls = namedtuple('Controls', ['left', 'right', 'jump', 'shoot'], defaults=(False, False, False, False))
+NO_INPUT = Controls()
+
+class KeyboardControls:
+    '''
+    Keys are read as held when a step asks for them. A click is only an event, so the game's event loop
+    latches it with click() until the next step takes it: a rendered frame that runs no step doesn't drop it.
+    '''
+    def __init__(self):
+        self.clicked = False
+
+    def click(self):
+        self.clicked = True
+
+    def __call__(self) -> Controls:
+        keys = pg.key.get_pressed()
+        shoot = self.clicked or keys[pg.K_LEFT] or keys[pg.K_RIGHT]
+        self.clicked = False
+        return Controls(left=keys[pg.K_a], right=keys[pg.K_d], jump=keys[pg.K_SPACE], shoot=shoot)
+
+class ScriptedControls:
+    def __init__(self):
+        self.current = NO_INPUT
+
+    def __call__(self) -> Controls:
+        return self.current
@@ -1,12 +1,259 @@
 from setup import *
+from math import ceil
+from bisect import bisect_left, bisect_right, insort
+from time import perf_counter_ns
+
+def scale_image(image, scale) -> pg.Surface:
+    width, height = image.get_size()
+    return pg.transform.scale(image, (max(1, round(width * scale)), max(1, round(height * scale))))
+
+class ScaledImages(dict):
+    '''
+    Sprite images scaled for drawing at one render scale, keyed by the full size image. The frames are
+    scaled up front by AllSprites.scale_frames, anything else is scaled on the first frame it is drawn.
+    '''
+    def __init__(self, scale: float):
+        super().__init__()
+        self.scale = scale
+
+    def __missing__(self, image):
+        scaled = self[image] = scale_image(image, self.scale)
+        return scaled
+
+class StaticLayer:
+    '''
+    Static tiles never move, so instead of blitting every tile each frame they are rendered into fixed-size
+    chunk surfaces, and drawing only blits the chunks that intersect the camera view. Chunks are baked from
+    the level's tile layers once the camera comes near, and dropped again once it is far away, so the memory
+    they take follows the area around the camera instead of the size of the map.
+    '''
+    def __init__(self, layers = (), chunk_tiles = CHUNK_TILES):
+        # TileLayers, baked into the same chunks in this order
+        self.layers = layers
+        self.chunk_tiles = chunk_tiles
+        self.chunk_size = TILE_SIZE * chunk_tiles
+        # A chunk without any tiles is kept as None, so it isn't baked again
+        self.chunks = {}
+        # Offset of each baked chunk inside its chunk cell, since baking crops away the empty space
+        self.chunk_offsets = {}
+        # For drawing below full resolution, scale: {key: (scaled chunk, its scaled position in the map)}
+        self.scaled_chunks = {}
+
+    def bake_chunk(self, key, convert = True):
+        '''
+        Renders the tiles of one chunk and crops it down to the area that actually holds tiles, so sparse
+        chunks cost less to blit. It is converted to the display format to keep the per-frame blits on
+        the fast path, unless it is baked on a loader thread, which leaves that to convert().
+        '''
+        size = self.chunk_size
+        area = pg.Rect(key[0] * size, key[1] * size, size, size)
+        chunk = pg.Surface((size, size), pg.SRCALPHA)
+        for layer in self.layers:
+            chunk.fblits(layer.tiles(area, (-area.x, -area.y)))
+        bounds = chunk.get_bounding_rect()
+        if not bounds.width:
+            self.chunks[key] = None
+            return
+        chunk = chunk.subsurface(bounds)
+        self.chunks[key] = chunk.convert_alpha() if convert else chunk.copy()
+        self.chunk_offsets[key] = bounds.topleft
+
+    def keys(self, rect) -> set:
+        '''Chunks that overlap the rect and lie inside the map'''
+        size = self.chunk_size
+        columns = -(-self.layers[0].width // self.chunk_tiles)
+        rows = -(-self.layers[0].height // self.chunk_tiles)
+        return {(x, y) for y in range(max(0, int(rect.top // size)), min(rows, ceil(rect.bottom / size)))
+                       for x in range(max(0, int(rect.left // size)), min(columns, ceil(rect.right / size)))}
+
+    def stream(self, view, convert = True):
+        '''
+        Bakes the chunks within one chunk of the view, and drops the ones more than two chunks away.
+        The gap in between keeps a camera moving back and forth over a chunk edge from rebaking it.
+        '''
+        size = self.chunk_size
+        for key in self.keys(view.inflate(size * 2, size * 2)):
+            if key not in self.chunks:
+                self.bake_chunk(key, convert)
+        keep = self.keys(view.inflate(size * 4, size * 4))
+        for key in [key for key in self.chunks if key not in keep]:
+            del self.chunks[key]
+            self.chunk_offsets.pop(key, None)
+            for chunks in self.scaled_chunks.values():
+                chunks.pop(key, None)
+
+    def convert(self):
+        '''Converts the chunks that are not in the display format yet, usually none since both are 32 bit ARGB'''
+        display_masks = pg.Surface((1, 1), pg.SRCALPHA).convert_alpha().get_masks()
+        for key, chunk in self.chunks.items():
+            if chunk and chunk.get_masks() != display_masks:
+                self.chunks[key] = chunk.convert_alpha()
+
+    def scaled_chunk(self, key, scale) -> tuple:
+        '''The chunk scaled down and its scaled position in the map, made once and dropped with the chunk'''
+        chunks = self.scaled_chunks.setdefault(scale, {})
+        if key not in chunks:
+            chunk = self.chunks[key]
+            x = key[0] * self.chunk_size + self.chunk_offsets[key][0]
+            y = key[1] * self.chunk_size + self.chunk_offsets[key][1]
+            # Edges are rounded in map space, so neighbouring chunks still meet without a seam
+            left, top = round(x * scale), round(y * scale)
+            right, bottom = round((x + chunk.get_width()) * scale), round((y + chunk.get_height()) * scale)
+            chunks[key] = (pg.transform.scale(chunk, (max(1, right - left), max(1, bottom - top))), (left, top))
+        return chunks[key]
+
+    def draw(self, surface, offset, scale = 1):
+        size = self.chunk_size
+        left, top = -offset.x, -offset.y
+        if self.layers:
+            self.stream(pg.FRect(left, top, DISPLAY_WIDTH, DISPLAY_HEIGHT))
+        # Every scaled chunk is moved by the same whole pixels, which keeps them lined up
+        scaled_x, scaled_y = round(offset.x * scale), round(offset.y * scale)
+        for y in range(int(top // size), ceil((top + DISPLAY_HEIGHT) / size)):
+            for x in range(int(left // size), ceil((left + DISPLAY_WIDTH) / size)):
+                chunk = self.chunks.get((x, y))
+                if not chunk:
+                    continue
+                if scale == 1:
+                    chunk_x, chunk_y = self.chunk_offsets[(x, y)]
+                    surface.blit(chunk, (x * size + chunk_x + offset.x, y * size + chunk_y + offset.y))
+                else:
+                    chunk, (chunk_x, chunk_y) = self.scaled_chunk((x, y), scale)
+                    surface.blit(chunk, (chunk_x + scaled_x, chunk_y + scaled_y))
+
+
+
+class RenderQueue:
+    '''
+    Keeps the sprites in draw order without sorting them every frame. Every sprite sits in the render layer
+    it was created with, and inside that layer in a bucket for the row of RENDER_BUCKET_HEIGHT pixels its
+    center is in. A sprite is only moved when it crosses into another row, and drawing walks the rows in
+    order, submitting everything in a single fblits call.
+    '''
+    def __init__(self):
+        # Per layer: the bucket of each row (sprites kept in insertion order) and the sorted row keys
+        self.buckets = [{} for _ in LAYERS]
+        self.rows = [[] for _ in LAYERS]
+        self.placement = {}
+        self.moved = []
+
+    def add(self, sprite):
+        layer, row = sprite.render_layer, int(sprite.rect.centery) // RENDER_BUCKET_HEIGHT
+        buckets = self.buckets[layer]
+        if row not in buckets:
+            buckets[row] = {}
+            insort(self.rows[layer], row)
+        buckets[row][sprite] = None
+        self.placement[sprite] = row
+
+    def remove(self, sprite):
+        row = self.placement.pop(sprite)
+        del self.buckets[sprite.render_layer][row][sprite]
+
+    def refresh(self):
+        '''Moves the sprites which crossed into a different row since the last refresh'''
+        for sprite, row in self.placement.items():
+            if int(sprite.rect.centery) // RENDER_BUCKET_HEIGHT != row:
+                self.moved.append(sprite)
+        for sprite in self.moved:
+            self.remove(sprite)
+            self.add(sprite)
+        self.moved.clear()
+
+    def blit_sequence(self, offset, alpha):
+        offset_x, offset_y = offset
+        # Rows just outside the view are still visited, since a sprite can reach past its own row
+        top = int(-offset_y - TILE_SIZE * 2) // RENDER_BUCKET_HEIGHT
+        bottom = int(-offset_y + DISPLAY_HEIGHT + TILE_SIZE * 2) // RENDER_BUCKET_HEIGHT
+        for buckets, rows in zip(self.buckets, self.rows):
+            for index in range(bisect_left(rows, top), bisect_right(rows, bottom)):
+                for sprite in buckets[rows[index]]:
+                    x, y = interpolate(sprite, alpha)
+                    yield sprite.image, (x + offset_x, y + offset_y)
+
+    def draw(self, surface, offset, alpha):
+        surface.fblits(self.blit_sequence(offset, alpha))
+
+    def draw_scaled(self, surface, offset, alpha, images: ScaledImages):
+        '''Same as draw, onto a surface images.scale times the size of the display'''
+        scale = images.scale
+        surface.fblits((images[image], (x * scale, y * scale)) for image, (x, y) in self.blit_sequence(offset, alpha))
+
+
+
+def interpolate(sprite, alpha):
+    '''Position of the sprite between the previous simulation step (alpha 0) and the current one (alpha 1)'''
+    rect, previous = sprite.rect, sprite.previous_pos
+    if previous is None:
+        return rect.x, rect.y
+    return previous[0] + (rect.x - previous[0]) * alpha, previous[1] + (rect.y - previous[1]) * alpha
+
+
 
 class AllSprites(pg.sprite.Group):
-    def __init__(self, *sprites):
+    def __init__(self, *sprites, profiler = None):
+        self.render_queue = RenderQueue()
+        self.profiler = profiler
         super().__init__(*sprites)
         self.display_surface = pg.display.get_surface()
         self.offset = pg.Vector2()
+        # Main and Decoration tiles are baked together, in that order, and drawn underneath the sprites.
+        # Every level bakes its own, and the current level's layer is swapped in here
+        self.static_layer = StaticLayer()
+        # Effects, drawn over every sprite
+        self.particles = None
+        # Drawing below full resolution, per scale: the offscreen surface the world is drawn to and the images
+        self.scaled_targets = {}
+        self.scaled_images = {}
+
+    def add_internal(self, sprite, layer = None):
+        super().add_internal(sprite, layer)
+        # Nothing to interpolate from until the sprite has been through a simulation step
+        sprite.previous_pos = None
+        self.render_queue.add(sprite)
+
+    def remove_internal(self, sprite):
+        super().remove_internal(sprite)
+        self.render_queue.remove(sprite)
+
+    def update(self, *args, **kwargs):
+        for sprite in self.spritedict:
+            sprite.previous_pos = sprite.rect.topleft
+        if self.profiler and self.profiler.enabled and self.profiler.per_class:
+            self.update_per_class(*args, **kwargs)
+        else:
+            super().update(*args, **kwargs)
+        self.render_queue.refresh()
+
+    def update_per_class(self, *args, **kwargs):
+        '''Same as Group.update, but every sprite class gets one profiler span with its total update time'''
+        totals = {}
+        start = perf_counter_ns()
+        for sprite in self.sprites():
+            sprite_start = perf_counter_ns()
+            sprite.update(*args, **kwargs)
+            name = type(sprite).__name__
+            totals[name] = totals.get(name, 0) + perf_counter_ns() - sprite_start
+        # Laid out one after another from the start, so the trace doesn't show them nested in each other
+        for name, duration in totals.items():
+            self.profiler.record(f'update {name}', start, duration)
+            start += duration
     
-    def draw(self, target_pos):
+    def scaled(self, scale) -> tuple:
+        '''The offscreen surface and the scaled images for drawing at scale'''
+        if scale not in self.scaled_targets:
+            self.scaled_targets[scale] = pg.Surface((round(DISPLAY_WIDTH * scale), round(DISPLAY_HEIGHT * scale))).convert()
+            self.scaled_images[scale] = ScaledImages(scale)
+        return self.scaled_targets[scale], self.scaled_images[scale]
+
+    def scale_frames(self, frame_caches, scales):
+        '''Scales every frame, flipped frame and silhouette up front for each render scale below full'''
+        for scale in scales:
+            target, images = self.scaled(scale)
+            images.update((image, scale_image(image, scale)) for frames in frame_caches
+                          for variants in (*frames.images, *frames.silhouettes) for image in variants)
+
+    def draw(self, target_pos, alpha = 1, particles = True, scale = 1):
         '''
         Camera Operation:
         Grabs the center position of the player (passed through in the game loop), and moves the game world
@@ -16,8 +263,18 @@ class AllSprites(pg.sprite.Group):
         self.offset.x = -(target_pos[0] - DISPLAY_WIDTH / 2)
         self.offset.y = -(target_pos[1] - DISPLAY_HEIGHT / 2)
 
-        ground_sprites = [sprite for sprite in self if hasattr(sprite, 'Main')]
-        object_sprites = [sprite for sprite in self if not hasattr(sprite, 'Main')]
-        for layer in [ground_sprites, object_sprites]:
-            for sprite in sorted(layer, key = lambda sprite: sprite.rect.centery):
-                self.display_surface.blit(sprite.image, sprite.rect.topleft + self.offset)
+        # Below full scale the world is drawn into a smaller offscreen surface, which is upscaled once
+        if scale == 1:
+            self.display_surface.fill(BACKGROUND_COLOR)
+            self.static_layer.draw(self.display_surface, self.offset)
+            self.render_queue.draw(self.display_surface, self.offset, alpha)
+        else:
+            surface, images = self.scaled(scale)
+            surface.fill(BACKGROUND_COLOR)
+            self.static_layer.draw(surface, self.offset, scale)
+            self.render_queue.draw_scaled(surface, self.offset, alpha, images)
+            pg.transform.scale(surface, self.display_surface.get_size(), self.display_surface)
+        # The quality governor leaves the particles out when drawing runs over budget. They go on top of
+        # everything, so even below full scale they are drawn straight to the display
+        if self.particles and particles:
+            self.particles.draw(self.display_surface, self.offset, alpha)
@@ -0,0 +1,88 @@
+from setup import *
+from threading import Thread
+from time import perf_counter
+from assets import asset_manager, entity
+from mapcache import load_map
+from groups import StaticLayer
+from platforms import PlatformGraph
+from sprites import ground, collision
+
+'''
+Levels are prepared in two halves. The slow half (compiling or loading the map, building the tile grid and
+the platform graph, and baking the static layer around the start) touches nothing the running game uses,
+so it runs on a worker thread while the current level is played. The main thread only does the handoff:
+converting what has to be in the display format and swapping the prepared level into the game. Everything
+further from the start is materialized by Regions and the static layer once the camera gets near.
+'''
+class Level:
+    def __init__(self, path):
+        self.path = path
+        self.map = load_map(path).convert(display_format=False)
+        self.width = self.map.width * TILE_SIZE
+        self.height = self.map.height * TILE_SIZE
+        self.worm_spawn_positions = []
+        self.player_start_pos = entity(self)
+
+        ground(self)
+        collision(self)
+        self.platforms = PlatformGraph.from_grid(self.tile_grid)
+        self.static_layer = StaticLayer(list(self.tile_layers.values()))
+        view = pg.FRect(0, 0, DISPLAY_WIDTH, DISPLAY_HEIGHT)
+        view.center = self.player_start_pos
+        self.static_layer.stream(view, convert=False)
+
+    def convert(self):
+        '''
+        Main thread half of the handoff. The map's surfaces are converted through the asset manager,
+        which also keeps it cached for as long as the level is played.
+        '''
+        self.map = asset_manager.map(self.path, compiled=self.map)
+        for layer in self.tile_layers.values():
+            layer.tile_images = self.map.tile_images
+        self.static_layer.convert()
+        return self
+
+class LevelLoader:
+    '''
+    Prepares one level at a time on a daemon thread. preload() starts it, take() hands the prepared
+    level over, or None while it is still being prepared. Errors from the thread are raised by take().
+    '''
+    def __init__(self):
+        self.thread = None
+        self.path = None
+        self.level = None
+        self.error = None
+        self.load_time = 0
+
+    def preload(self, path):
+        if self.thread and self.path == path:
+            return
+        self.wait()
+        self.path, self.level, self.error = path, None, None
+        self.thread = Thread(target=self.work, args=(path,), name='level-loader', daemon=True)
+        self.thread.start()
+
+    def work(self, path):
+        start = perf_counter()
+        try:
+            self.level = Level(path)
+        except Exception as error:
+            self.error = error
+        self.load_time = perf_counter() - start
+
+    def ready(self) -> bool:
+        return self.thread is not None and not self.thread.is_alive()
+
+    def wait(self):
+        if self.thread:
+            self.thread.join()
+
+    def take(self, wait = False):
+        if self.thread is None or not (wait or self.ready()):
+            return None
+        self.wait()
+        level, error = self.level, self.error
+        self.thread = self.path = self.level = self.error = None
+        if error:
+            raise error
+        return level
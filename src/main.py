@@ -2,112 +2,355 @@ from setup import *
 from settings import *
 from assets import * 
 from sprites import *
-from groups import AllSprites
-from timerclass import Timer
-from random import randint
+from groups import AllSprites, interpolate
+from controls import Controls, ScriptedControls, KeyboardControls
+from profiler import Profiler
+from broadphase import SpatialHash, swept_rect, swept_mask_collide
+from swarm import BeeSwarm
+from particles import ParticleSystem
+from quality import QualityGovernor
+from levels import Level, LevelLoader
+from regions import Regions
+from timerclass import Timer, Scheduler
+from replay import Recording, Recorder, ReplayControls
+from snapshot import SnapshotRing, snapshot, restore
+from random import Random, randrange
+from math import pi
+from time import perf_counter
+from argparse import ArgumentParser
 
 class Game:
-    def __init__(self):
+    def __init__(self, headless = False, map_path = None, seed = None):
         # Initialization 
-        self.display = initialize() 
+        self.headless = headless
+        # Everything random in the simulation comes from this generator, so a seed and the inputs replay a game
+        self.seed = randrange(1 << 63) if seed is None else seed
+        self.rng = Random(self.seed)
+        self.map_path = map_path or IMAGE_PATHS['map']
+        self.display = initialize(headless) 
         self.clock = pg.Clock()
         self.running = True
+        self.sim_time = 0   # Seconds of simulated time
+        self.frame = 0      # Simulation steps taken
+        self.kill_count = 0
+        self.scheduler = Scheduler()
+        self.profiler = Profiler()
+        # Only interactive games are governed, headless runs and benchmarks always draw at full quality
+        self.governor = QualityGovernor(enabled=QUALITY_GOVERNOR and not headless)
 
         # Groups
-        self.all_sprites = AllSprites()
+        self.all_sprites = AllSprites(profiler=self.profiler)
         self.enemy_sprites = pg.sprite.Group()
-        self.collision_sprites = pg.sprite.Group()
         self.bullet_sprites = pg.sprite.Group()
+        self.enemy_hash = SpatialHash()
+
+        # Pools, so short lived sprites are reused instead of allocated for every spawn and shot
+        self.bee_pool = Pool(Bee, self.all_sprites, self.enemy_sprites)
+        self.bullet_pool = Pool(Bullet, self.all_sprites, self.bullet_sprites)
 
         # Spawn loading
-        self.worm_spawn_positions = []
         self.bee_spawn_positions = []
-        self.player_start_pos = load_assets(self)
+        load_assets(self)
+        self.bee_swarm = BeeSwarm(self.bee_frames, self.bee_pool, self.scheduler)
+        self.particles = self.all_sprites.particles = ParticleSystem(self.particle_atlas)
+        # Sprite frames drawn below full resolution are scaled here once, never while drawing
+        if not headless:
+            self.all_sprites.scale_frames((self.player_frames, self.bee_frames, self.worm_frames, self.bullet_frames),
+                                          self.governor.scales)
         
         # Timers
         self.bees = True
         if self.bees:
-            self.bee_timer = Timer(200, func=self.create_bee, repeat=True, autostart=True)
-            self.bee_timer.activate()
+            self.bee_timer = Timer(self.scheduler, 200, func=self.create_bee, repeat=True, autostart=True)
+
+        # Snapshots of the last steps for rewinding, and the checkpoint F5 saves and F9 goes back to
+        self.history = SnapshotRing(SNAPSHOT_HISTORY)
+        self.checkpoint = None
+
+        # Levels. The first one is prepared right away, every next one in the background while playing
+        self.level = None
+        self.level_loader = LevelLoader()
+        self.enter_level(Level(self.map_path))
         self.setup()
 
         # Class instances
-        self.player = Player(self.player_frames, self.player_start_pos, self.clock, self.create_bullet, 
-                             self.collision_sprites, self.all_sprites)
+        self.controls = ScriptedControls() if headless else KeyboardControls()
+        self.player = Player(self.player_frames, self.player_start_pos, self.create_bullet, 
+                             self.tile_grid, self.controls, self.scheduler, self.all_sprites)
+        self.regions.update(self.player.rect.center, self.sim_time)
 
-        for pos, area in zip(self.worm_spawn_positions, self.worm_spawn_area):
-                self.worm = Worm(self.worm_frames, pos, area,
-                                self.collision_sprites, self.enemy_sprites, self.all_sprites)
 
+    def create_bee(self) -> list:
+        '''Called by the bee timer, spawns BEES_PER_SPAWN bees and returns their swarm indices'''
+        return [self.spawn_bee() for _ in range(BEES_PER_SPAWN)]
 
-    def create_bee(self):
-        self.bee = Bee(frames=self.bee_frames,
-                       pos=((self.map_width + DISPLAY_WIDTH), randint(100,self.map_height)),
-                       speed=randint(300,500), 
-                       groups=(self.all_sprites, self.enemy_sprites))
+    def spawn_bee(self) -> int:
+        return self.bee_swarm.spawn(pos=((self.map_width + DISPLAY_WIDTH), self.rng.randint(100,self.map_height)),
+                                    speed=self.rng.randint(300,500),
+                                    amplitude=self.rng.randint(500,600),
+                                    frequency=self.rng.randint(300,600),
+                                    time=self.sim_time * 1000)
         
     def create_bullet(self, pos, direction):
         x = pos[0] + direction * 34 if direction == 1 else pos[0] + direction * 34 - self.bullet_png.get_width()
-        self.bullet = Bullet(self.bullet_png, (x, pos[1]), direction, 
-                             (self.all_sprites, self.bullet_sprites))
-        
-        Fire(self.fire_png, pos, self.player, self.all_sprites)
+        self.bullet = self.bullet_pool.acquire(self.bullet_frames, (x, pos[1]), direction)
+
+        # The muzzle flash moves along with the player for its short life, the sparks fly off the barrel
+        player = self.player
+        flash_width = self.fire_png.get_width()
+        barrel = (player.rect.right + flash_width / 2 if direction == 1 else player.rect.left - flash_width / 2,
+                  player.rect.centery + 9)
+        velocity = (player.player_dir.x * player.player_speed, 0)
+        self.particles.emit('muzzle' if direction == 1 else 'muzzle_left', barrel, lifetime=0.1, velocity=velocity)
+        self.particles.emit('spark', barrel, count=4, speed=250, direction=0 if direction == 1 else pi, spread=0.5,
+                            lifetime=0.15, velocity=velocity)
+
+    def spawn_worm(self, pos, area) -> tuple:
+        area = TransparentSprite((area.x, area.y), area.width, area.height, self.all_sprites, RGB=(255,0,0), debug=DEBUG)
+        self.worm = Worm(self.worm_frames, pos, area, self.platforms, self.scheduler, self.enemy_sprites, self.all_sprites)
+        return area, self.worm
+
+    def next_level_path(self) -> str:
+        if self.map_path not in LEVEL_PATHS:
+            return LEVEL_PATHS[0]
+        return LEVEL_PATHS[(LEVEL_PATHS.index(self.map_path) + 1) % len(LEVEL_PATHS)]
+
+    def enter_level(self, level):
+        '''
+        Swaps a prepared level in, on the main thread. Everything slow was done while the level was prepared,
+        so this converts a few surfaces and moves references around, well within one frame.
+        '''
+        level.convert()
+        # Snapshots are only valid within the level they were taken in
+        self.level_number = self.level_number + 1 if self.level else 0
+        if self.level:
+            asset_manager.release(self.level.path)
+            self.regions.clear()
+            for sprite in self.enemy_sprites.sprites() + self.bullet_sprites.sprites():
+                sprite.kill()
+            self.bee_swarm.clear()
+            self.particles.clear()
+            self.history.clear()
+            self.checkpoint = None
+
+        self.level = level
+        self.map_path = level.path
+        self.map = level.map
+        self.map_width, self.map_height = level.width, level.height
+        self.tile_grid = level.tile_grid
+        self.platforms = level.platforms
+        self.player_start_pos = level.player_start_pos
+        self.all_sprites.static_layer = level.static_layer
+        self.regions = Regions(level, self.spawn_worm)
+
+        # The next level is prepared while this one is played
+        self.level_loader.preload(self.next_level_path())
+
+    def next_level(self):
+        # Only waits if the player got here before the loader thread was done
+        self.enter_level(self.level_loader.take(wait=True))
+        self.player.respawn(self.player_start_pos, self.tile_grid)
+        self.regions.update(self.player.rect.center, self.sim_time)
+
+    def close(self):
+        '''
+        Releases the current level and the assets of the game. Whatever no other game holds is dropped, so a
+        game that replaces this one should be created before this is called, to take the cached assets over.
+        '''
+        self.level_loader.wait()
+        asset_manager.release(self.level.path)
+        unload_assets(self)
+
+    def record(self) -> Recording:
+        '''Records the controls of every step from here on. Called before the first step, it can replay the whole game'''
+        recording = Recording(self.seed, self.map_path)
+        self.player.controls = Recorder(self.player.controls, recording)
+        return recording
+
+    def snapshot(self):
+        '''The whole simulation state as one flat array, see snapshot.py'''
+        return snapshot(self)
+
+    def restore(self, buffer):
+        '''Puts the simulation back to a snapshot taken in the current level'''
+        restore(self, buffer)
+        # Recordings and replays start at the first step, so going back in time goes back in them too
+        controls = self.player.controls
+        if isinstance(controls, Recorder):
+            del controls.recording.steps[self.frame:]
+        elif isinstance(controls, ReplayControls):
+            controls.step = self.frame
+
+    def pool_stats(self) -> dict:
+        return {'bee': self.bee_pool.stats(), 'bullet': self.bullet_pool.stats()}
 
     def collision(self):
+        '''
+        Enemies are filed into a spatial hash once per step. Bullets query it with the area they swept
+        since the last step, and only enemies whose rect overlaps that area get the mask test.
+        '''
+        self.enemy_hash.rebuild(self.enemy_sprites)
         for bullet in self.bullet_sprites:
-            sprite_collsion = pg.sprite.spritecollide(bullet, self.enemy_sprites, False, pg.sprite.collide_mask)
+            sprite_collsion = [sprite for sprite in self.enemy_hash.query(swept_rect(bullet))
+                               if swept_mask_collide(bullet, sprite)]
             if sprite_collsion:
                 bullet.kill()
                 impact_sound()
+                # Sparks bounce back the way the bullet came
+                self.particles.emit('spark', bullet.rect.center, count=10, speed=350,
+                                    direction=pi if bullet.bullet_dir == 1 else 0, spread=1.2, lifetime=0.25, gravity=900)
                 for sprite in sprite_collsion:
+                    # A dying enemy can still be hit while it flashes, it only counts once
+                    if not sprite.death_timer:
+                        self.kill_count += 1
+                        self.particles.emit('debris', sprite.rect.center, count=16, speed=300, spread=pi,
+                                            lifetime=0.5, gravity=1200)
                     sprite.destroy()
 
-            # If the player collides with an enemy, game ends
-            if pg.sprite.spritecollide(self.player, self.enemy_sprites, False, pg.sprite.collide_mask):
-                if not DEBUG:
-                    self.running = True
+        # If the player collides with an enemy, game ends
+        if any(pg.sprite.collide_mask(self.player, sprite) for sprite in self.enemy_hash.query(self.player.rect)):
+            if not DEBUG:
+                self.running = True
 
     def setup(self):
-        ground(self)
-        objects(self)
-        collision(self)
-        if not DEBUG:
+        if not DEBUG and not self.headless:
             music(self)
 
 
-    def run(self):
-        while self.running:
-            dt = self.clock.tick(FPS) / 1000 
-
-            for event in pg.event.get():
-                if event.type == pg.QUIT: 
-                    self.running = False 
-                elif event.type == pg.KEYDOWN:
-                    if event.key == pg.K_ESCAPE:
-                        self.running = False
-            # Player jumps off the map
-            if self.player.rect.y > 2200:
-                self.running = False
-            
-            # update
-            if self.bees:
-                self.bee_timer.update()
+    def update(self, dt):
+        '''Advances the simulation by one fixed step'''
+        # Player jumps off the map
+        if self.player.rect.y > 2200:
+            self.running = False
+        # Walking off the right edge of the map takes the player to the next level
+        if self.player.rect.left > self.map_width:
+            with self.profiler.span('level'):
+                self.next_level()
+
+        with self.profiler.span('timers'):
+            self.scheduler.advance(dt * 1000)
+        with self.profiler.span('regions'):
+            self.regions.update(self.player.rect.center, self.sim_time)
+        with self.profiler.span('sprites'):
             self.all_sprites.update(dt)
+        with self.profiler.span('swarm'):
+            self.bee_swarm.update(dt, self.player.rect.center)
+        with self.profiler.span('particles'):
+            self.particles.update(dt)
 
+        with self.profiler.span('collision'):
             self.collision()
-            # draw 
-            self.display.fill(BACKGROUND_COLOR)
-            self.all_sprites.draw(self.player.rect.center)
+        self.sim_time += dt
+        self.frame += 1
+
+    def step(self, n_frames = 1, inputs = None):
+        '''
+        Advances a headless game by n_frames simulation steps as fast as possible, with no rendering.
+        Inputs is either one Controls held for every step, or a sequence of Controls, one per step.
+        Returns False once the game has ended.
+        '''
+        for frame in range(n_frames):
+            if not self.running:
+                break
+            if inputs is not None:
+                self.controls.current = inputs if isinstance(inputs, Controls) else inputs[frame]
+            self.profiler.begin_frame()
+            self.update(SIM_DT)
+            self.profiler.end_frame()
+        return self.running
+
+    def draw(self, alpha):
+        '''Alpha is how far we are between the previous and the current simulation step'''
+        x, y = interpolate(self.player, alpha)
+        self.all_sprites.draw((x + self.player.rect.width / 2, y + self.player.rect.height / 2), alpha,
+                              self.governor.particles, self.governor.scale)
 
+        if not self.governor.extras:
+            return
+        fps_counter(self.display, self.clock, FPS_TOGGLE)   
+        if self.profiler.enabled:
+            self.profiler.draw_overlay(self.display, (40, 4))
+        if DEBUG:
+            player_position_text(self.display, self.player.rect.x, self.player.rect.y)        
 
-            fps_counter(self.display, self.clock, FPS_TOGGLE)   
-            if DEBUG:
-                player_position_text(self.display, self.player.rect.x, self.player.rect.y)        
-            pg.display.flip()
+    def run(self, steps = None):
+        '''
+        The simulation always advances in fixed steps of SIM_DT, no matter how fast we render. The time
+        of each rendered frame is added to an accumulator and spent in whole steps, and whatever is left
+        over is used to interpolate the sprites between the last two steps when drawing.
+        Steps ends the game after that many simulation steps, e.g. at the end of a replay.
+        '''
+        accumulator = 0
+        while self.running and (steps is None or self.frame < steps):
+            # Clamped so that one long frame can't make us fall further and further behind
+            accumulator += min(self.clock.tick(FPS) / 1000, MAX_FRAME_TIME)
+            self.profiler.begin_frame()
+
+            with self.profiler.span('events'):
+                for event in pg.event.get():
+                    if event.type == pg.QUIT: 
+                        self.running = False 
+                    elif event.type == pg.MOUSEBUTTONDOWN and event.button == 1 and not self.headless:
+                        self.controls.click()
+                    elif event.type == pg.KEYDOWN:
+                        if event.key == pg.K_ESCAPE:
+                            self.running = False
+                        # F3 toggles the profiler and its overlay, F4 saves what it recorded
+                        elif event.key == pg.K_F3:
+                            self.profiler.toggle()
+                        elif event.key == pg.K_F4:
+                            self.profiler.export_chrome_trace(join(BASE_PATH, 'profile_trace.json'))
+                        # F5 saves a checkpoint, F9 goes back to it
+                        elif event.key == pg.K_F5:
+                            self.checkpoint = self.snapshot()
+                        elif event.key == pg.K_F9 and self.checkpoint is not None:
+                            self.restore(self.checkpoint)
+                            self.history.clear()
+
+            # Holding backspace rewinds, one recorded step per simulation step
+            rewinding = pg.key.get_pressed()[pg.K_BACKSPACE]
+
+            # update
+            while accumulator >= SIM_DT and self.running and (steps is None or self.frame < steps):
+                accumulator -= SIM_DT
+                if rewinding:
+                    if len(self.history):
+                        self.restore(self.history.pop())
+                    continue
+                with self.profiler.span('snapshot'):
+                    self.history.push(self.snapshot())
+                self.update(SIM_DT)
+
+            # draw 
+            # Only drawing is governed, so only drawing and presenting count against the budget. With pg.SCALED
+            # the frame is presented in flip, which doesn't wait for vsync on a governed display
+            draw_start = perf_counter()
+            with self.profiler.span('draw'):
+                self.draw(accumulator / SIM_DT)
+            with self.profiler.span('flip'):
+                pg.display.flip()
+            self.governor.record((perf_counter() - draw_start) * 1000)
+            self.profiler.end_frame()
         
+        self.close()
         pg.quit()
 
 if __name__ == '__main__':
-    game = Game()
+    parser = ArgumentParser(description='Platform')
+    parser.add_argument('--seed', type=int, help='seed for everything random in the game')
+    parser.add_argument('--record', metavar='PATH', help='record the session to PATH, replay it with src/replay.py')
+    parser.add_argument('--quality', type=int, metavar='LEVEL', help='fix the render quality to one of QUALITY_LEVELS, 0 is the best')
+    args = parser.parse_args()
+    # Recordings store the seed as a u64
+    if args.seed is not None and not 0 <= args.seed < 1 << 64:
+        parser.error('--seed has to be between 0 and 2**64 - 1')
+
+    game = Game(seed=args.seed)
+    if args.quality is not None:
+        game.governor.enabled = False
+        game.governor.set_level(args.quality)
+    recording = game.record() if args.record else None
     game.run()
+    if recording:
+        recording.save(args.record)
     
\ No newline at end of file
@@ -0,0 +1,223 @@
+from setup import *
+import hashlib
+import json
+import shutil
+import sys
+import tempfile
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+import numpy as np
+import pytmx
+
+'''
+Map compiler. Parsing a TMX file means parsing XML and slicing the tileset images into single tile
+surfaces, on every start. Instead a map is compiled once into a folder under CACHE_PATH holding:
+
+    meta.json    map size, layer names, objects, the sources the artifact was built from, and its name
+    <artifact>/  named after the version and the content hash of the sources, holding
+        layers.npy   tile ids of every tile layer, (layers, height, width) uint16, 0 is an empty cell
+        atlas.npy    every tile the map uses, already unpacked to RGBA pixels in one atlas
+        tiles.npy    the (x, y, w, h) of each tile id in the atlas
+
+The arrays are memory mapped when loaded. The artifact is rebuilt when the modification time of one of
+its sources changed and their content hash no longer matches.
+
+Several processes (e.g. batch workers) may load or compile the same map at once, so nothing a reader could
+have open is ever written in place. An artifact is built in a temporary folder and renamed into place whole,
+after which it never changes, and meta.json is swapped in with a rename once the artifact it names exists.
+
+    python src/mapcache.py data/maps/world.tmx
+'''
+CACHE_PATH = join(BASE_PATH, 'cache', 'maps')
+FORMAT_VERSION = 2
+ATLAS_COLUMNS = 16
+
+MapObject = namedtuple('MapObject', ['name', 'x', 'y', 'width', 'height', 'type'])
+
+class CompiledMap:
+    def __init__(self, meta, layers, atlas_pixels, tile_rects):
+        self.width = meta['width']
+        self.height = meta['height']
+        self.tilewidth = meta['tilewidth']
+        self.tileheight = meta['tileheight']
+        self.layer_names = meta['layers']
+        self.object_groups = {name: [MapObject(*obj) for obj in objects] for name, objects in meta['objects'].items()}
+        self.layers = layers
+        self.atlas_pixels = atlas_pixels
+        self.tile_rects = tile_rects
+        self.tile_images = None
+
+    def convert(self, display_format = True):
+        '''
+        Turns the atlas into a display format surface, and every tile into a subsurface of it.
+        Loader threads pass display_format=False and get surfaces that point into the raw atlas pixels.
+        '''
+        height, width = self.atlas_pixels.shape[:2]
+        atlas = pg.image.frombuffer(self.atlas_pixels, (width, height), 'RGBA')
+        if display_format:
+            atlas = atlas.convert_alpha()
+        self.tile_images = [None] + [atlas.subsurface(rect) for rect in self.tile_rects.tolist()]
+        return self
+
+    def layer(self, name) -> np.ndarray:
+        return self.layers[self.layer_names.index(name)]
+
+    def tiles(self, name):
+        '''Yields (x, y, image) for every tile of the layer, like pytmx does'''
+        ids = self.layer(name)
+        rows, cols = np.nonzero(ids)
+        for x, y, tile in zip(cols.tolist(), rows.tolist(), ids[rows, cols].tolist()):
+            yield x, y, self.tile_images[tile]
+
+    def objects(self, name) -> list:
+        return self.object_groups[name]
+
+def cache_folder(tmx_path) -> str:
+    path = os.path.abspath(tmx_path)
+    name = os.path.splitext(os.path.basename(path))[0]
+    return join(CACHE_PATH, f"{name}-{hashlib.sha1(path.encode()).hexdigest()[:10]}")
+
+def map_sources(tmx_path) -> list:
+    '''The TMX file, the external tilesets it references and their images'''
+    sources = [os.path.abspath(tmx_path)]
+    for tileset in ET.parse(tmx_path).getroot().iter('tileset'):
+        folder = os.path.dirname(tmx_path)
+        if tileset.get('source'):
+            tsx = os.path.normpath(join(folder, tileset.get('source')))
+            sources.append(tsx)
+            folder, tileset = os.path.dirname(tsx), ET.parse(tsx).getroot()
+        for image in tileset.iter('image'):
+            sources.append(os.path.normpath(join(folder, image.get('source'))))
+    return list(dict.fromkeys(sources))
+
+def stamp(path) -> list:
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+def content_hash(sources) -> str:
+    digest = hashlib.sha1()
+    for source in sources:
+        with open(source, 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+def write_meta(folder, meta):
+    '''Replaces meta.json in one rename, so readers see either the old or the new file, never half of one'''
+    handle, temporary = tempfile.mkstemp(dir=folder, prefix='meta-', suffix='.tmp')
+    with os.fdopen(handle, 'w') as file:
+        json.dump(meta, file)
+    os.replace(temporary, join(folder, 'meta.json'))
+
+def compile_map(tmx_path, folder) -> dict:
+    '''
+    Parses the TMX file (without loading any images through pytmx), writes the artifact to folder and
+    returns its meta
+    '''
+    tmx = pytmx.TiledMap(tmx_path)
+    sheets = {}
+    atlas_index = {}    # (image path, source rect, flags) -> tile id
+    gid_to_tile = np.zeros(len(tmx.images), dtype=np.uint16)
+    for gid, info in enumerate(tmx.images):
+        if info:
+            # The same tileset referenced at two firstgids yields the same key, so its tiles are stored once
+            gid_to_tile[gid] = atlas_index.setdefault(tuple(info), len(atlas_index) + 1)
+
+    rows = max(1, -(-len(atlas_index) // ATLAS_COLUMNS))
+    atlas = pg.Surface((ATLAS_COLUMNS * tmx.tilewidth, rows * tmx.tileheight), pg.SRCALPHA)
+    tile_rects = np.zeros((len(atlas_index), 4), dtype=np.int32)
+    for (path, rect, flags), tile in atlas_index.items():
+        if path not in sheets:
+            sheets[path] = pg.image.load(path)
+        image = sheets[path].subsurface(rect)
+        if flags.flipped_diagonally:
+            image = pg.transform.flip(pg.transform.rotate(image, 270), True, False)
+        image = pg.transform.flip(image, flags.flipped_horizontally, flags.flipped_vertically)
+        x, y = (tile - 1) % ATLAS_COLUMNS * tmx.tilewidth, (tile - 1) // ATLAS_COLUMNS * tmx.tileheight
+        atlas.blit(image, (x, y))
+        tile_rects[tile - 1] = (x, y, *image.get_size())
+
+    tile_layers = [layer for layer in tmx.layers if isinstance(layer, pytmx.TiledTileLayer)]
+    layers = np.zeros((len(tile_layers), tmx.height, tmx.width), dtype=np.uint16)
+    for index, layer in enumerate(tile_layers):
+        layers[index] = gid_to_tile[np.asarray(layer.data, dtype=np.intp)]
+
+    objects = {group.name: [[obj.name, obj.x, obj.y, obj.width, obj.height, obj.type] for obj in group]
+               for group in tmx.layers if isinstance(group, pytmx.TiledObjectGroup)}
+    sources = map_sources(tmx_path)
+    digest = content_hash(sources)
+    meta = {
+        'version'   : FORMAT_VERSION,
+        'artifact'  : f"v{FORMAT_VERSION}-{digest[:16]}",
+        'width'     : tmx.width,
+        'height'    : tmx.height,
+        'tilewidth' : tmx.tilewidth,
+        'tileheight': tmx.tileheight,
+        'layers'    : [layer.name for layer in tile_layers],
+        'objects'   : objects,
+        'sources'   : {source: stamp(source) for source in sources},
+        'hash'      : digest,
+    }
+
+    os.makedirs(folder, exist_ok=True)
+    build = tempfile.mkdtemp(dir=folder, prefix='build-')
+    np.save(join(build, 'layers.npy'), layers)
+    pixels = np.frombuffer(pg.image.tobytes(atlas, 'RGBA'), dtype=np.uint8)
+    np.save(join(build, 'atlas.npy'), pixels.reshape(atlas.get_height(), atlas.get_width(), 4))
+    np.save(join(build, 'tiles.npy'), tile_rects)
+    try:
+        os.replace(build, join(folder, meta['artifact']))
+    except OSError:
+        # Another process got the same artifact in place first, and it is identical
+        shutil.rmtree(build, ignore_errors=True)
+    write_meta(folder, meta)
+
+    # Artifacts of older versions of the map. One still mapped by a running game stays readable until
+    # it is closed, except on Windows, where removing it fails and it is left for next time
+    for name in os.listdir(folder):
+        if name.startswith('v') and name != meta['artifact'] and os.path.isdir(join(folder, name)):
+            shutil.rmtree(join(folder, name), ignore_errors=True)
+    return meta
+
+def cached_meta(folder):
+    '''The meta of the artifact in folder if it is up to date with its sources, otherwise None'''
+    try:
+        with open(join(folder, 'meta.json')) as file:
+            meta = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if meta.get('version') != FORMAT_VERSION or not os.path.isdir(join(folder, meta['artifact'])):
+        return None
+    try:
+        stamps = {source: stamp(source) for source in meta['sources']}
+    except OSError:
+        return None
+    if stamps == meta['sources']:
+        return meta
+    # Touched but maybe not changed, e.g. after a checkout, so fall back to comparing the content
+    if content_hash(meta['sources']) != meta['hash']:
+        return None
+    meta['sources'] = stamps
+    write_meta(folder, meta)
+    return meta
+
+def load_map(tmx_path) -> CompiledMap:
+    '''Loads the compiled map, compiling it first if there is no up to date artifact'''
+    folder = cache_folder(tmx_path)
+    meta = cached_meta(folder) or compile_map(tmx_path, folder)
+    try:
+        artifact = join(folder, meta['artifact'])
+        arrays = [np.load(join(artifact, 'layers.npy'), mmap_mode='r'),
+                  np.load(join(artifact, 'atlas.npy'), mmap_mode='r'),
+                  np.load(join(artifact, 'tiles.npy'))]
+    except FileNotFoundError:
+        # A process that compiled a newer version of the map removed this artifact in the meantime
+        meta = compile_map(tmx_path, folder)
+        artifact = join(folder, meta['artifact'])
+        arrays = [np.load(join(artifact, name), mmap_mode='r') for name in ('layers.npy', 'atlas.npy')]
+        arrays.append(np.load(join(artifact, 'tiles.npy')))
+    return CompiledMap(meta, *arrays)
+
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        compile_map(path, cache_folder(path))
+        print(f"{path} -> {cache_folder(path)}")
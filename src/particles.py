@@ -0,0 +1,133 @@
+from setup import *
+import numpy as np
+
+'''
+Short lived visual effects (muzzle flashes, impact sparks, enemy debris) are particles rather than sprites.
+Every particle is one entry in preallocated NumPy arrays, all of them are moved in one vectorized step, and
+they are drawn with one fblits call from the frames of a shared atlas. Particles never collide and never
+touch the simulation, so any number of them costs no Python objects and nothing in all_sprites.
+'''
+# Golden ratio conjugates, spread the particles of a burst evenly without drawing on the game's random generator
+SPREAD_ANGLE, SPREAD_SPEED = 0.6180339887, 0.7548776662
+ARRAYS = ('x', 'y', 'vx', 'vy', 'gravity', 'age', 'lifetime', 'first', 'frame_count')
+
+def dot_frames(color, radius: int, count: int) -> list:
+    '''A dot shrinking to nothing over count frames'''
+    frames = []
+    for index in range(count):
+        size = max(1, round(radius * (1 - index / count)))
+        surf = pg.Surface((size * 2, size * 2), pg.SRCALPHA)
+        pg.draw.circle(surf, color, (size, size), size)
+        frames.append(surf)
+    return frames
+
+class ParticleAtlas:
+    '''
+    Every particle image packed side by side in one surface. A kind of particle is a run of frames in it,
+    played over the particle's lifetime, and every frame is a subsurface of the atlas.
+    '''
+    def __init__(self, kinds: dict):
+        width = sum(surf.get_width() for frames in kinds.values() for surf in frames)
+        height = max(surf.get_height() for frames in kinds.values() for surf in frames)
+        surface = pg.Surface((width, height), pg.SRCALPHA)
+        areas = []
+        self.kinds = {}     # name: (first frame, frame count)
+        x = 0
+        for name, frames in kinds.items():
+            self.kinds[name] = (len(areas), len(frames))
+            for surf in frames:
+                surface.blit(surf, (x, 0))
+                areas.append((x, 0, *surf.get_size()))
+                x += surf.get_width()
+        self.surface = surface.convert_alpha()
+        self.frames = [self.surface.subsurface(area) for area in areas]
+        # Half sizes, particle positions are their centers
+        self.half_sizes = np.array([frame.get_size() for frame in self.frames], dtype=float) / 2
+
+def particle_atlas(fire_png) -> ParticleAtlas:
+    return ParticleAtlas({
+        'muzzle'        : [fire_png],
+        'muzzle_left'   : [pg.transform.flip(fire_png, True, False)],
+        'spark'         : dot_frames('#ffd34e', 4, 4),
+        'debris'        : dot_frames('#3b2a20', 5, 5),
+    })
+
+class ParticleSystem:
+    def __init__(self, atlas: ParticleAtlas, capacity = PARTICLE_CAPACITY):
+        self.atlas = atlas
+        self.x = np.zeros(capacity)
+        self.y = np.zeros(capacity)
+        self.vx = np.zeros(capacity)
+        self.vy = np.zeros(capacity)
+        self.gravity = np.zeros(capacity)
+        self.age = np.zeros(capacity)
+        self.lifetime = np.ones(capacity)
+        self.first = np.zeros(capacity, dtype=np.int32)
+        self.frame_count = np.ones(capacity, dtype=np.int32)
+        # Live particles are always the first count entries
+        self.count = 0
+        # Particles ever emitted, which picks where in the spread the next ones go
+        self.emitted = 0
+
+    def __len__(self):
+        return self.count
+
+    def emit(self, kind, pos, count = 1, speed = 0, direction = 0, spread = 0, lifetime = 0.3, gravity = 0,
+             velocity = (0, 0)):
+        '''
+        Count particles of a kind at pos, flying at up to speed in directions within spread (radians) either
+        side of direction, on top of velocity. Particles beyond the capacity are dropped.
+        '''
+        start, end = self.count, min(self.count + count, len(self.x))
+        if start == end:
+            return
+        sequence = np.arange(self.emitted, self.emitted + end - start)
+        angles = direction + spread * (2 * (sequence * SPREAD_ANGLE % 1) - 1)
+        speeds = speed * (0.5 + 0.5 * (sequence * SPREAD_SPEED % 1))
+        self.x[start:end], self.y[start:end] = pos
+        self.vx[start:end] = velocity[0] + np.cos(angles) * speeds
+        self.vy[start:end] = velocity[1] + np.sin(angles) * speeds
+        self.gravity[start:end] = gravity
+        self.age[start:end] = 0
+        self.lifetime[start:end] = lifetime
+        self.first[start:end], self.frame_count[start:end] = self.atlas.kinds[kind]
+        self.count = end
+        self.emitted += end - start
+
+    def update(self, dt):
+        count = self.count
+        if not count:
+            return
+        self.age[:count] += dt
+        self.vy[:count] += self.gravity[:count] * dt
+        self.x[:count] += self.vx[:count] * dt
+        self.y[:count] += self.vy[:count] * dt
+
+        # Expired particles are dropped by packing the live ones to the front
+        live = self.age[:count] < self.lifetime[:count]
+        if not live.all():
+            kept = int(np.count_nonzero(live))
+            for name in ARRAYS:
+                array = getattr(self, name)
+                array[:kept] = array[:count][live]
+            self.count = kept
+
+    def clear(self):
+        self.count = 0
+
+    def draw(self, surface, offset, alpha = 1):
+        '''Draws every particle on screen, moved back along its velocity to between the last two steps'''
+        count = self.count
+        if not count:
+            return
+        progress = self.age[:count] / self.lifetime[:count]
+        frames = self.first[:count] + np.minimum((progress * self.frame_count[:count]).astype(np.int32),
+                                                 self.frame_count[:count] - 1)
+        half_sizes = self.atlas.half_sizes[frames]
+        behind = (alpha - 1) * SIM_DT
+        x = self.x[:count] + self.vx[:count] * behind + offset[0] - half_sizes[:, 0]
+        y = self.y[:count] + self.vy[:count] * behind + offset[1] - half_sizes[:, 1]
+        visible = (x > -TILE_SIZE) & (x < DISPLAY_WIDTH) & (y > -TILE_SIZE) & (y < DISPLAY_HEIGHT)
+        images = self.atlas.frames
+        surface.fblits([(images[frame], (left, top)) for frame, left, top in
+                        zip(frames[visible].tolist(), x[visible].tolist(), y[visible].tolist())])
@@ -0,0 +1,151 @@
+from setup import *
+from bisect import bisect_left
+from operator import attrgetter
+from heapq import heappush, heappop
+import numpy as np
+
+'''
+The Main layer analysed into the platforms ground enemies walk on. A platform is a run of solid cells in one
+row with nothing solid on top, so its surface can be walked from end to end without any collision checks.
+Platforms are linked where an enemy can get from one to another: walking off a ledge drops onto the first
+platform below it, and platforms within PLATFORM_JUMP_REACH of each other are linked by a jump. Worms only
+patrol their own platform, path() finds a route over the links for anything that can do more.
+'''
+class Platform:
+    def __init__(self, index: int, row: int, first: int, last: int, tile_size: int):
+        self.index = index
+        self.row = row
+        # Surface in pixels: the platform spans left to right at height top
+        self.left = first * tile_size
+        self.right = (last + 1) * tile_size
+        self.top = row * tile_size
+        # What is past either end, 'ledge' or 'wall', a wall rises right next to the surface
+        self.ends = ('ledge', 'ledge')
+        # (platform index, 'drop' or 'jump', x the link is taken at, cost)
+        self.links = []
+
+    def __repr__(self):
+        return f"Platform({self.index}, row={self.row}, x={self.left}-{self.right})"
+
+class PlatformGraph:
+    def __init__(self, grid, platforms: list):
+        self.grid = grid
+        self.platforms = platforms
+        # Column: (tops, platform indices) of the platforms covering it, top to bottom
+        self.columns = [([], []) for _ in range(grid.width)]
+        size = grid.tile_size
+        for platform in sorted(platforms, key=attrgetter('top')):
+            for col in range(platform.left // size, platform.right // size):
+                tops, indices = self.columns[col]
+                tops.append(platform.top)
+                indices.append(platform.index)
+
+    def __len__(self):
+        return len(self.platforms)
+
+    def __getitem__(self, index: int) -> Platform:
+        return self.platforms[index]
+
+    @classmethod
+    def from_grid(cls, grid, jump_reach = PLATFORM_JUMP_REACH):
+        '''Finds every platform of a TileGrid, and links them'''
+        solid = np.frombuffer(grid.cells, dtype=np.uint8).reshape(grid.height, grid.width).astype(bool)
+        above = np.zeros_like(solid)
+        above[1:] = solid[:-1]
+        surface = solid & ~above
+
+        platforms = []
+        for row in np.flatnonzero(surface.any(axis=1)).tolist():
+            # Runs of surface cells, from where the padded row steps up to where it steps down
+            steps = np.diff(np.concatenate(([0], surface[row].view(np.int8), [0])))
+            for first, end in zip(np.flatnonzero(steps == 1).tolist(), np.flatnonzero(steps == -1).tolist()):
+                platform = Platform(len(platforms), row, first, end - 1, grid.tile_size)
+                # Cells beside a surface that are solid have something solid on top, so they are a wall
+                platform.ends = tuple('wall' if grid.is_solid(col, row) else 'ledge' for col in (first - 1, end))
+                platforms.append(platform)
+
+        graph = cls(grid, platforms)
+        graph.link(jump_reach)
+        return graph
+
+    def platform_at(self, pos, tolerance: float = 0):
+        '''The platform under pos: the first one covering its column whose top is at or below pos'''
+        col = int(pos[0] // self.grid.tile_size)
+        if not 0 <= col < len(self.columns):
+            return None
+        tops, indices = self.columns[col]
+        index = bisect_left(tops, pos[1] - tolerance)
+        return self.platforms[indices[index]] if index < len(indices) else None
+
+    def link(self, jump_reach):
+        size = self.grid.tile_size
+        reach_x = jump_reach[0] * size
+        # Platforms of every row, left to right, with their right edges to search them by
+        rows = {}
+        for platform in self.platforms:
+            rows.setdefault(platform.row, []).append(platform)
+        rights = {row: [platform.right for platform in platforms] for row, platforms in rows.items()}
+
+        for platform in self.platforms:
+            # Walking off a ledge drops onto whatever is below the next column
+            for end, x, col in zip(platform.ends, (platform.left, platform.right),
+                                   (platform.left // size - 1, platform.right // size)):
+                below = self.platform_at((col * size + size / 2, platform.top + 1)) if end == 'ledge' else None
+                if below:
+                    platform.links.append((below.index, 'drop', x, below.top - platform.top))
+
+            # Jumps go across a gap of at most reach_x, to platforms up to as many rows higher or lower. Anything
+            # deeper is reached by dropping, and platforms overlapping this one are in the way of a jump
+            linked = {index for index, *_ in platform.links}
+            for row in range(platform.row - jump_reach[1], platform.row + jump_reach[1] + 1):
+                candidates = rows.get(row, ())
+                for other in candidates[bisect_left(rights.get(row, ()), platform.left - reach_x):]:
+                    if other.left > platform.right + reach_x:
+                        break
+                    if other is platform or other.index in linked:
+                        continue
+                    if other.left >= platform.right:
+                        x, gap = platform.right, other.left - platform.right
+                    elif other.right <= platform.left:
+                        x, gap = platform.left, platform.left - other.right
+                    else:
+                        continue
+                    platform.links.append((other.index, 'jump', x, gap + abs(other.top - platform.top)))
+
+    def path(self, start, goal, jumps: bool = True) -> list:
+        '''
+        The cheapest route from the platform under start to the one under goal, as a list of (platform,
+        x it is left at) ending with the goal's platform and goal x. Cost is the distance walked plus the
+        height dropped or jumped. Without jumps only drops are taken. None if there is no route.
+        '''
+        first, last = self.platform_at(start), self.platform_at(goal)
+        if first is None or last is None:
+            return None
+        best = {first.index: 0}
+        came_from = {}
+        queue = [(0, first.index, start[0])]
+        while queue:
+            cost, index, x = heappop(queue)
+            if index == last.index:
+                break
+            if cost > best[index]:
+                continue
+            for other, kind, link_x, link_cost in self.platforms[index].links:
+                if kind == 'jump' and not jumps:
+                    continue
+                total = cost + abs(link_x - x) + link_cost
+                if total < best.get(other, float('inf')):
+                    best[other] = total
+                    came_from[other] = (index, link_x)
+                    # Landing at the same x that was jumped or dropped from, within the other platform
+                    platform = self.platforms[other]
+                    heappush(queue, (total, other, min(max(link_x, platform.left), platform.right)))
+        else:
+            return None
+
+        route = [(last, goal[0])]
+        index = last.index
+        while index != first.index:
+            index, x = came_from[index]
+            route.append((self.platforms[index], x))
+        return route[::-1]
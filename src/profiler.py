@@ -0,0 +1,98 @@
+from setup import *
+from collections import deque
+from contextlib import nullcontext
+from time import perf_counter_ns
+import json
+
+'''
+Frame profiler. Stages of the game loop are wrapped in named spans, each finished frame is kept in a
+ring buffer of the last PROFILER_FRAMES frames, and the buffer can be exported as Chrome trace-event JSON
+(open it in chrome://tracing or ui.perfetto.dev). When the profiler is disabled span() hands back one
+shared no-op context, so instrumented code costs about as much as a function call.
+'''
+NULL_SPAN = nullcontext()
+
+# Overlay colors per stage, anything else is drawn grey
+STAGE_COLORS = {'events': '#8e44ad', 'timers': '#f39c12', 'swarm': '#d35400', 'sprites': '#27ae60', 'collision': '#c0392b',
+                'draw': '#2980b9', 'flip': '#7f8c8d', 'level': '#16a085', 'regions': '#2c3e50',
+                'snapshot': '#95a5a6', 'particles': '#e67e22'}
+
+class Span:
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, self.start, perf_counter_ns() - self.start)
+
+
+
+class Profiler:
+    def __init__(self, enabled = PROFILER, per_class = PROFILE_SPRITE_CLASSES, capacity = PROFILER_FRAMES):
+        self.enabled = enabled
+        # Also time AllSprites.update per sprite class
+        self.per_class = per_class
+        # Every frame is (start, duration, [(name, start, duration), ...]) in nanoseconds
+        self.frames = deque(maxlen=capacity)
+        self.spans = None
+        self.frame_start = 0
+
+    def span(self, name):
+        return Span(self, name) if self.spans is not None else NULL_SPAN
+
+    def record(self, name, start, duration):
+        if self.spans is not None:
+            self.spans.append((name, start, duration))
+
+    def begin_frame(self):
+        if self.enabled:
+            self.spans = []
+            self.frame_start = perf_counter_ns()
+
+    def end_frame(self):
+        if self.spans is not None:
+            self.frames.append((self.frame_start, perf_counter_ns() - self.frame_start, self.spans))
+            self.spans = None
+
+    def toggle(self):
+        self.enabled = not self.enabled
+
+    def chrome_trace(self) -> dict:
+        events = []
+        for start, duration, spans in self.frames:
+            events.append({'name': 'frame', 'cat': 'frame', 'ph': 'X', 'pid': 1, 'tid': 1,
+                           'ts': start / 1000, 'dur': duration / 1000})
+            for name, span_start, span_duration in spans:
+                events.append({'name': name, 'cat': 'stage', 'ph': 'X', 'pid': 1, 'tid': 1,
+                               'ts': span_start / 1000, 'dur': span_duration / 1000})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def export_chrome_trace(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.chrome_trace(), file)
+
+    def draw_overlay(self, display, pos, frames = 120, scale = 4):
+        '''
+        Bar graph of the last frames, one pixel column per frame, scale pixels per millisecond. Every bar
+        is stacked from the stages of that frame, the line marks the frame budget for the target FPS.
+        '''
+        left, top = pos
+        height = int(1000 / FPS * scale * 2)
+        pg.draw.rect(display, (0, 0, 0), (left, top, frames, height))
+        recent = list(self.frames)[-frames:]
+        for x, (_, duration, spans) in enumerate(recent, start = left + frames - len(recent)):
+            bottom = top + height
+            for name, _, span_duration in spans:
+                # Only the top level stages, sprite class spans are nested inside 'sprites'
+                if name in STAGE_COLORS:
+                    bar = span_duration / 1e6 * scale
+                    pg.draw.line(display, STAGE_COLORS[name], (x, bottom), (x, max(top, bottom - bar)))
+                    bottom -= bar
+        budget = top + height - 1000 / FPS * scale
+        pg.draw.line(display, 'white', (left, budget), (left + frames, budget))
@@ -0,0 +1,60 @@
+from setup import *
+from collections import deque
+
+'''
+Keeps the frame rate up on weak hardware by lowering the render quality instead of letting frames run long.
+The governor watches how long recent frames took to draw and present, and steps through QUALITY_LEVELS:
+first the extras (FPS text, profiler overlay, debug text) go, then the particles, then the world is drawn at
+a lower internal resolution into an offscreen surface that is upscaled to the display. Everything drawn at
+a lower scale is scaled ahead of time, the baked tile chunks once per chunk and the sprite frames when the
+game starts, so a scaled frame costs fewer pixels and one upscale. Once frames are fast again it steps back
+up. The simulation runs in fixed steps either way, only what is drawn changes.
+'''
+class QualityGovernor:
+    def __init__(self, levels = QUALITY_LEVELS, budget = 1000 / FPS * GOVERNOR_DRAW_SHARE, window = GOVERNOR_WINDOW,
+                 enabled = True):
+        self.levels = levels
+        self.level = 0
+        self.budget = budget
+        self.enabled = enabled
+        # Milliseconds spent drawing and presenting each recent frame
+        self.times = deque(maxlen=window)
+
+    @property
+    def scale(self) -> float:
+        return self.levels[self.level][0]
+
+    @property
+    def extras(self) -> bool:
+        return self.levels[self.level][1]
+
+    @property
+    def particles(self) -> bool:
+        return self.levels[self.level][2]
+
+    @property
+    def scales(self) -> list:
+        '''Every render scale below full the levels use'''
+        return sorted({level[0] for level in self.levels if level[0] != 1})
+
+    def set_level(self, level: int):
+        self.level = max(0, min(level, len(self.levels) - 1))
+        # Frames drawn at the old level say nothing about the new one
+        self.times.clear()
+
+    def record(self, ms: float):
+        '''
+        Adds the draw and present time of a frame. Once a whole window of frames is in, a window averaging over
+        the budget steps the quality down, and one averaging under GOVERNOR_RECOVER of the budget steps it back up.
+        '''
+        if not self.enabled:
+            return
+        times = self.times
+        times.append(ms)
+        if len(times) < times.maxlen:
+            return
+        average = sum(times) / len(times)
+        if average > self.budget and self.level < len(self.levels) - 1:
+            self.set_level(self.level + 1)
+        elif average < self.budget * GOVERNOR_RECOVER and self.level > 0:
+            self.set_level(self.level - 1)
@@ -0,0 +1,86 @@
+from setup import *
+from math import ceil
+
+'''
+The world is split into square regions of REGION_TILES tiles. Regions near the camera are materialized:
+the worms that start in them are spawned the first time. Once the camera is far away again the region is
+released, and the entities in it are suspended. A suspended entity is taken out of its groups, so nothing
+updates, draws or collides with it, until its region is materialized again. It is then fast forwarded by
+the time it missed, so the work per step follows the area around the camera instead of the map's size.
+'''
+class Regions:
+    def __init__(self, level, spawn_worm, size = TILE_SIZE * REGION_TILES):
+        self.level = level
+        # Called with a spawn position and its area object, returns the sprites it made
+        self.spawn_worm = spawn_worm
+        self.size = size
+
+        # Materialized regions, keyed by their (column, row)
+        self.active = set()
+        # Every worm spawn is numbered, region: [spawns whose region has not been materialized yet]
+        self.spawns = list(zip(level.worm_spawn_positions, level.worm_spawn_area))
+        self.pending = {}
+        for spawn, (pos, area) in enumerate(self.spawns):
+            self.pending.setdefault(self.key(pos), []).append(spawn)
+        # spawn: [(sprite, the groups it was made in)] for the spawns that have been made
+        self.spawned = {}
+        # region: [(sprite, its groups, sim time it was suspended at)]
+        self.suspended = {}
+        # Materialized entities, the only ones checked every step
+        self.entities = []
+
+    def key(self, pos) -> tuple:
+        return (int(pos[0] // self.size), int(pos[1] // self.size))
+
+    def keys(self, center, margin) -> set:
+        '''Regions overlapping the camera view around center, grown by margin on every side'''
+        size = self.size
+        left, right = center[0] - DISPLAY_WIDTH / 2 - margin[0], center[0] + DISPLAY_WIDTH / 2 + margin[0]
+        top, bottom = center[1] - DISPLAY_HEIGHT / 2 - margin[1], center[1] + DISPLAY_HEIGHT / 2 + margin[1]
+        return {(x, y) for x in range(int(left // size), ceil(right / size))
+                       for y in range(int(top // size), ceil(bottom / size))}
+
+    def update(self, center, now):
+        '''
+        Materializes the regions within REGION_ACTIVE_MARGIN of the camera and releases the ones more than a
+        region further out, so a camera moving back and forth over a region edge doesn't churn it.
+        '''
+        margin_x, margin_y = REGION_ACTIVE_MARGIN
+        for key in self.keys(center, REGION_ACTIVE_MARGIN) - self.active:
+            self.materialize(key, now)
+        keep = self.keys(center, (margin_x + self.size, margin_y + self.size))
+        self.active &= keep
+
+        # Entities that walked out of the materialized regions are suspended where they are. Dying
+        # enemies are left alone, their death timer is about to kill them anyway
+        entities = []
+        for sprite in self.entities:
+            if not sprite.alive():
+                continue
+            if self.key(sprite.rect.center) in self.active or getattr(sprite, 'death_timer', False):
+                entities.append(sprite)
+            else:
+                self.suspend(sprite, now)
+        self.entities = entities
+
+    def materialize(self, key, now):
+        self.active.add(key)
+        for spawn in self.pending.pop(key, ()):
+            sprites = self.spawn_worm(*self.spawns[spawn])
+            self.spawned[spawn] = [(sprite, sprite.groups()) for sprite in sprites]
+            self.entities.extend(sprites)
+        for sprite, groups, suspended_at in self.suspended.pop(key, ()):
+            if hasattr(sprite, 'fast_forward'):
+                sprite.fast_forward(now - suspended_at)
+            sprite.add(*groups)
+            self.entities.append(sprite)
+
+    def suspend(self, sprite, now):
+        self.suspended.setdefault(self.key(sprite.rect.center), []).append((sprite, sprite.groups(), now))
+        sprite.kill()
+
+    def clear(self):
+        '''Kills every materialized entity and drops the rest, for when the level is left'''
+        for sprite in self.entities:
+            sprite.kill()
+        self.active, self.entities, self.pending, self.suspended, self.spawned = set(), [], {}, {}, {}
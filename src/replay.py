@@ -0,0 +1,159 @@
+import json
+import os
+import struct
+import time
+from argparse import ArgumentParser
+
+# Keeps stdout clean for the JSON report
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+from setup import *
+from controls import Controls, NO_INPUT
+
+'''
+Recording and replay of play sessions. A game is fully determined by its seed, its first map and the
+Controls the player saw at every simulation step, so that is all a recording holds. Controls are packed
+into four bits per step, and runs of identical steps are stored once with their length:
+
+    header    b'PLRC', format version (u16), seed (u64), steps (u32), map path length (u16), map path (utf-8)
+    runs      (controls bits (u8), steps (u16)) until all steps are covered
+
+    python src/main.py --record session.rec
+    python src/replay.py session.rec --headless --output timings.json
+'''
+MAGIC = b'PLRC'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sHQIH')
+RUN = struct.Struct('<BH')
+
+def pack(controls: Controls) -> int:
+    return controls.left | controls.right << 1 | controls.jump << 2 | controls.shoot << 3
+
+def unpack(bits: int) -> Controls:
+    return Controls(bool(bits & 1), bool(bits & 2), bool(bits & 4), bool(bits & 8))
+
+class Recording:
+    def __init__(self, seed: int, map_path: str, steps = None):
+        # Checked up front, a seed the header can't hold would otherwise only fail once the session is saved
+        if not 0 <= seed < 1 << 64:
+            raise ValueError(f"A recording's seed has to fit in 64 bits unsigned, {seed} doesn't")
+        self.seed = seed
+        self.map_path = map_path
+        # One byte of controls bits per simulation step
+        self.steps = steps or bytearray()
+
+    def __len__(self):
+        return len(self.steps)
+
+    def append(self, controls: Controls):
+        self.steps.append(pack(controls))
+
+    def controls(self, step: int) -> Controls:
+        return unpack(self.steps[step]) if step < len(self.steps) else NO_INPUT
+
+    def save(self, path):
+        # Maps inside the game folder are stored relative to it, so recordings work from any checkout
+        map_path = os.path.relpath(self.map_path, BASE_PATH) if self.map_path.startswith(BASE_PATH) else self.map_path
+        map_path = map_path.encode()
+        runs = bytearray()
+        step = 0
+        while step < len(self.steps):
+            bits, end = self.steps[step], step + 1
+            while end < len(self.steps) and self.steps[end] == bits and end - step < 0xFFFF:
+                end += 1
+            runs += RUN.pack(bits, end - step)
+            step = end
+        with open(path, 'wb') as file:
+            file.write(HEADER.pack(MAGIC, FORMAT_VERSION, self.seed, len(self.steps), len(map_path)))
+            file.write(map_path)
+            file.write(runs)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as file:
+            data = file.read()
+        magic, version, seed, length, path_length = HEADER.unpack_from(data)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"{path} is not a version {FORMAT_VERSION} recording")
+        start = HEADER.size + path_length
+        map_path = join(BASE_PATH, data[HEADER.size:start].decode())
+        steps = bytearray()
+        for bits, count in RUN.iter_unpack(data[start:]):
+            steps += bytes((bits,)) * count
+        if len(steps) != length:
+            raise ValueError(f"{path} is truncated")
+        return cls(seed, map_path, steps)
+
+class Recorder:
+    '''Input source that passes the Controls of another source through, adding every step to the recording'''
+    def __init__(self, source, recording: Recording):
+        self.source = source
+        self.recording = recording
+
+    def __call__(self) -> Controls:
+        controls = self.source()
+        self.recording.append(controls)
+        return controls
+
+class ReplayControls:
+    '''Input source that plays a recording back one step at a time, and no input after its end'''
+    def __init__(self, recording: Recording):
+        self.recording = recording
+        self.step = 0
+
+    def __call__(self) -> Controls:
+        controls = self.recording.controls(self.step)
+        self.step += 1
+        return controls
+
+def replay(path, headless = False) -> dict:
+    '''
+    Plays a recording back. With a window it runs at the normal frame rate, headless it runs every step
+    as fast as possible and reports the time of each, updating and drawing, so two builds can be compared
+    on exactly the same session. The final state is included to check that both replayed it the same way.
+    '''
+    from main import Game
+    from benchmark import percentiles
+
+    recording = Recording.load(path)
+    game = Game(headless=headless, map_path=recording.map_path, seed=recording.seed)
+    game.player.controls = ReplayControls(recording)
+    if not headless:
+        game.run(steps=len(recording))
+        return {}
+
+    # The next level is prepared on a thread, it should not compete with the measured steps
+    game.level_loader.wait()
+    frames = []
+    for _ in range(len(recording)):
+        start = time.perf_counter()
+        game.update(SIM_DT)
+        game.draw(1)
+        frames.append(time.perf_counter() - start)
+        if not game.running:
+            break
+    return {
+        'recording' : path,
+        'steps'     : len(frames),
+        'timings'   : percentiles(frames),
+        'final'     : {'player': list(game.player.rect.topleft), 'kills': game.kill_count,
+                       'enemies': len(game.enemy_sprites), 'swarm': len(game.bee_swarm)},
+    }
+
+def main():
+    parser = ArgumentParser(description='Replays a recorded session')
+    parser.add_argument('recording')
+    parser.add_argument('--headless', action='store_true', help='run as fast as possible and report step times')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    report = replay(args.recording, args.headless)
+    if not args.headless:
+        return
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,60 @@
 import pygame as pg
 from assets import *
 from os.path import join
+from functools import lru_cache
+
+TEXT_CACHE_SIZE = 128   # Rendered text surfaces kept around before the least recently used is dropped
+DIGITS = '0123456789-'
+
+'''
+Text should always be a string type, numbers that change every frame are passed as an int and are
+composed from pre-rendered digit glyphs instead of rasterizing the whole string again.
+'''
+fonts = {}
 
-'''Text should always be a string type'''
 def font(font_size):
-    return pg.font.Font(font_path, size=font_size)
+    # Only the first use of a size opens the font file
+    if font_size not in fonts:
+        fonts[font_size] = pg.font.Font(font_path, size=font_size)
+    return fonts[font_size]
+
+@lru_cache(maxsize=TEXT_CACHE_SIZE)
+def render_text(text, font_size, color):
+    return font(font_size).render(text, antialias=True, color=color)
+
+@lru_cache(maxsize=None)
+def digit_glyphs(font_size, color):
+    return {digit: font(font_size).render(digit, antialias=True, color=color) for digit in DIGITS}
+
+def hud_surfaces(parts, font_size, color):
+    surfaces = []
+    for part in parts:
+        if isinstance(part, int):
+            glyphs = digit_glyphs(font_size, color)
+            surfaces.extend(glyphs[digit] for digit in str(part))
+        else:
+            surfaces.append(render_text(part, font_size, color))
+    return surfaces
+
+def draw_text(display, parts, font_size, color, pos, align_right = False):
+    '''Blits the parts next to each other, pos is the top right corner when aligned to the right'''
+    surfaces = hud_surfaces(parts, font_size, color)
+    x, y = pos
+    if align_right:
+        x -= sum(surface.get_width() for surface in surfaces)
+    for surface in surfaces:
+        display.blit(surface, (x, y))
+        x += surface.get_width()
 
 def fps_counter(display, clock, FPS_TOGGLE):
     if FPS_TOGGLE:
-        fps = str(int(clock.get_fps()))
-        fps_t = font(18).render(fps, antialias=True, color='red')
-        display.blit(fps_t,(2,2)) 
+        draw_text(display, [int(clock.get_fps())], 18, 'red', (2,2))
 
 def kill_text(display, kill_count):
-    kill_t = font(35).render(f" KILL COUNT: {str(kill_count)}", antialias=True, color='red')
-    text_width = kill_t.get_width()
-    x_position = 1278 - text_width  
-    display.blit(kill_t, (x_position, 2))
+    draw_text(display, [" KILL COUNT: ", int(kill_count)], 35, 'red', (1278, 2), align_right=True)
 
 def player_position_text(display, player_rectx, player_recty):
-    kill_t = font(35).render(f" Position: ({str(int(player_rectx))},{str(int(player_recty))})", antialias=True, color='red')
-    text_width = kill_t.get_width()
-    x_position = 1278 - text_width  
-    display.blit(kill_t, (x_position, 2))
+    draw_text(display, [" Position: (", int(player_rectx), ",", int(player_recty), ")"], 35, 'red', (1278, 2), align_right=True)
 
 
 font_path = join(BASE_PATH,'data', 'Oxanium-Bold.ttf')
\ No newline at end of file
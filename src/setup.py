@@ -6,17 +6,58 @@ from os.path import join
 # Global variables
 DEBUG = False
 FPS = 120
+SIM_RATE = 120          # Simulation steps per second, independent of the render rate
+SIM_DT = 1 / SIM_RATE
+MAX_FRAME_TIME = 0.25   # Longest frame the simulation will try to catch up on
 FPS_TOGGLE = True
+PROFILER = False                # Record frame timings from the start, F3 toggles it in game
+PROFILER_FRAMES = 3000          # Frames kept in the profiler's ring buffer
+PROFILE_SPRITE_CLASSES = False  # Also time the sprite update per sprite class
+QUALITY_GOVERNOR = True         # Lower the render quality when frames go over budget
+# Quality levels the governor steps through, best first: (internal render scale, draw the extras, draw the particles)
+QUALITY_LEVELS = ((1, True, True), (1, False, True), (1, False, False), (0.75, False, False), (0.5, False, False))
+GOVERNOR_DRAW_SHARE = 0.5       # Share of the frame budget drawing and presenting may take, the rest is the simulation's
+GOVERNOR_WINDOW = 60            # Frames averaged before the governor changes the quality
+GOVERNOR_RECOVER = 0.5          # Quality goes back up once frames average under this much of the budget
 TILE_SIZE = 64
+CHUNK_TILES = 8    # Static tile layers are baked into chunks of CHUNK_TILES x CHUNK_TILES tiles
 DISPLAY_WIDTH, DISPLAY_HEIGHT = 1280, 720
 BACKGROUND_COLOR = "#fcdfcd"
+
+# Render layers, drawn from lowest to highest
+LAYERS = {'ground': 0, 'decoration': 1, 'entities': 2, 'projectiles': 3, 'effects': 4}
+RENDER_BUCKET_HEIGHT = 16   # Sprites are y-ordered in rows of this many pixels
+BROADPHASE_CELL_SIZE = 128  # Cell size of the spatial hash used for bullet, enemy and player collisions
+BEES_PER_SPAWN = 1          # Bees added to the swarm every time the bee timer fires, raise it for bee hell
+# Bees this far (x, y) outside the camera view still get a sprite. Bullets fly two screen widths from the player
+SWARM_ACTIVE_MARGIN = (DISPLAY_WIDTH * 1.5, TILE_SIZE * 2)
+REGION_TILES = 16      # Entities are materialized in square regions of this many tiles
+# Regions this far (x, y) outside the camera view are materialized, further out their entities are suspended
+REGION_ACTIVE_MARGIN = SWARM_ACTIVE_MARGIN
+PLATFORM_JUMP_REACH = (4, 3)   # Tiles (across, up or down) between platforms linked by a jump
+PARTICLE_CAPACITY = 4096      # Particles alive at once, further ones are dropped
+SNAPSHOT_HISTORY = SIM_RATE * 5   # Steps kept for rewinding, one snapshot per simulation step
+# Mixer channels reserved for each sound category, also the most voices it plays at once
+SOUND_CATEGORIES = {'weapon': 4, 'impact': 4}
+SOUND_COALESCE_MS = 40         # The same sound played again within this long makes the playing voice louder
+SOUND_COALESCE_GAIN = 0.25     # Loudness added by every merged play, up to SOUND_COALESCE_MAX times the volume
+SOUND_COALESCE_MAX = 2
 BASE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
-def initialize():
+def initialize(headless = False):
+    if headless:
+        # No window and no sound card, the drivers have to be picked before pygame starts
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'
+        os.environ['SDL_AUDIODRIVER'] = 'dummy'
     pg.init()
     pg.mixer.init()
 
-    display = pg.display.set_mode((DISPLAY_WIDTH, DISPLAY_HEIGHT), flags=pg.SCALED, vsync=1)
+    if headless:
+        display = pg.display.set_mode((DISPLAY_WIDTH, DISPLAY_HEIGHT))
+    else:
+        # A governed display isn't vsynced, flip would wait for the vertical blank where the governor times
+        # what presenting costs. clock.tick(FPS) paces the frames instead
+        display = pg.display.set_mode((DISPLAY_WIDTH, DISPLAY_HEIGHT), flags=pg.SCALED, vsync=0 if QUALITY_GOVERNOR else 1)
     pg.display.set_caption("Platform")
     
     return display
\ No newline at end of file
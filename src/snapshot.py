@@ -0,0 +1,269 @@
+from setup import *
+from heapq import heapify
+from math import isnan, nan
+from particles import ARRAYS as PARTICLE_ARRAYS
+import numpy as np
+
+'''
+Snapshots of the whole simulation. Everything a step depends on is written into one flat float64 array:
+the game's counters and random generator, the scheduler's clock, every timer, the player, the worms of
+every spawn, the bee swarm's arrays and its sprites, the bullets and the particles. What can be
+derived again (images, masks, render queue rows, the enemy hash) is not stored. Restoring writes the
+values back into the existing objects, and takes or returns pooled sprites to match the snapshot.
+A snapshot belongs to the level it was taken in.
+
+    history = SnapshotRing(600)
+    history.push(snapshot(game))
+    restore(game, history.back(120))
+'''
+FORMAT_VERSION = 2
+# Worm spawn states
+PENDING, MATERIALIZED, SUSPENDED, DEAD = range(4)
+SWARM_ARRAYS = ('x', 'y', 'speed', 'amplitude', 'frequency', 'time', 'alive', 'dying', 'has_sprite')
+
+class Writer:
+    def __init__(self):
+        self.parts = []
+        self.values = []
+
+    def add(self, *values):
+        self.values.extend(values)
+
+    def array(self, array):
+        self.add(len(array))
+        self.parts.append(np.array(self.values, dtype=np.float64))
+        self.parts.append(np.asarray(array, dtype=np.float64))
+        self.values = []
+
+    def timer(self, timer, sequences):
+        # Sequence is the scheduler's tie breaker for the timer's entry, -1 if it isn't scheduled
+        self.add(timer.active, timer.start_time, sequences.get(timer, -1))
+
+    def buffer(self) -> np.ndarray:
+        self.parts.append(np.array(self.values, dtype=np.float64))
+        return np.concatenate(self.parts)
+
+class Reader:
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.values = buffer.tolist()
+        self.position = 0
+
+    def next(self) -> float:
+        self.position += 1
+        return self.values[self.position - 1]
+
+    def take(self, count: int) -> list:
+        self.position += count
+        return self.values[self.position - count:self.position]
+
+    def array(self) -> np.ndarray:
+        count = int(self.next())
+        self.position += count
+        return self.buffer[self.position - count:self.position]
+
+    def timer(self, timer, entries):
+        active, start_time, sequence = self.take(3)
+        # Whatever entry the timer had in the queue is stale now
+        timer.generation += 1
+        timer.active, timer.start_time = bool(active), start_time
+        if active:
+            entries.append((start_time + timer.duration, int(sequence), timer, timer.generation))
+
+def snapshot(game) -> np.ndarray:
+    scheduler = game.scheduler
+    sequences = {timer: sequence for due, sequence, timer, generation in scheduler.queue
+                 if timer.active and timer.generation == generation}
+    out = Writer()
+    out.add(FORMAT_VERSION, game.level_number, game.frame, game.sim_time, game.kill_count, game.running,
+            scheduler.now, scheduler.sequence)
+    version, state, gauss = game.rng.getstate()
+    out.array(state)
+    out.add(nan if gauss is None else gauss)
+    out.timer(game.bee_timer, sequences)
+
+    player = game.player
+    out.add(*player.rect_hitbox, *player.rect.topleft, *player.player_dir, player.frame_index, player.flip,
+            player.jumping, player.jump_pressed, player.on_floor, player.in_hangtime, player.jump_timer,
+            player.hangtime_timer, getattr(player, 'jump_start_y', 0), getattr(player, 'player_velocity', 0),
+            player.jump_velocity_PPF)
+    out.timer(player.shoot_timer, sequences)
+
+    regions = game.regions
+    out.array([value for key in sorted(regions.active) for value in key])
+    suspended = {sprite: suspended_at for entries in regions.suspended.values()
+                 for sprite, groups, suspended_at in entries}
+    out.add(len(regions.spawns))
+    for spawn in range(len(regions.spawns)):
+        if spawn not in regions.spawned:
+            out.add(PENDING)
+            continue
+        area, worm = (sprite for sprite, groups in regions.spawned[spawn])
+        for sprite in (area, worm):
+            if sprite.alive():
+                out.add(MATERIALIZED, 0)
+            elif sprite in suspended:
+                out.add(SUSPENDED, suspended[sprite])
+            else:
+                out.add(DEAD, 0)
+        out.add(*worm.rect_hitbox.topleft, *worm.rect.topleft, *worm.worm_dir, worm.frame_index, worm.flip,
+                worm.animation_speed)
+        out.timer(worm.death_timer, sequences)
+
+    swarm = game.bee_swarm
+    out.array(swarm.free_slots)
+    for name in SWARM_ARRAYS:
+        out.array(getattr(swarm, name))
+    for index in np.flatnonzero(swarm.has_sprite).tolist():
+        bee = swarm.sprites[index]
+        out.add(*bee.rect.topleft, bee.frame_index, bee.flip, bee.animation_speed)
+        out.timer(bee.death_timer, sequences)
+
+    bullets = game.bullet_sprites.sprites()
+    out.add(len(bullets))
+    for bullet in bullets:
+        out.add(*bullet.rect.topleft, bullet.bullet_dir, bullet.distance)
+    particles = game.particles
+    out.add(particles.emitted)
+    for name in PARTICLE_ARRAYS:
+        out.array(getattr(particles, name)[:particles.count])
+    return out.buffer()
+
+def restore(game, buffer: np.ndarray):
+    data = Reader(buffer)
+    version, level_number = data.take(2)
+    if version != FORMAT_VERSION or level_number != game.level_number:
+        raise ValueError('The snapshot was taken in another level or by another version')
+    game.frame, game.sim_time, game.kill_count, running, now, sequence = data.take(6)
+    game.frame, game.kill_count, game.running = int(game.frame), int(game.kill_count), bool(running)
+    state = tuple(int(value) for value in data.array())
+    gauss = data.next()
+    game.rng.setstate((3, state, None if isnan(gauss) else gauss))
+    # The queue is rebuilt from the timers in the snapshot, which drops the entries of every other timer
+    entries = []
+    data.timer(game.bee_timer, entries)
+
+    player = game.player
+    x, y, width, height, rect_x, rect_y, dir_x, dir_y = data.take(8)
+    player.rect_hitbox.update(x, y, width, height)
+    player.rect.topleft = (rect_x, rect_y)
+    player.player_dir.update(dir_x, dir_y)
+    (player.frame_index, flip, jumping, jump_pressed, on_floor, in_hangtime, player.jump_timer,
+     player.hangtime_timer, player.jump_start_y, player.player_velocity, player.jump_velocity_PPF) = data.take(11)
+    player.flip, player.jumping, player.jump_pressed = bool(flip), bool(jumping), bool(jump_pressed)
+    player.on_floor, player.in_hangtime = bool(on_floor), bool(in_hangtime)
+    player.set_frame()
+    data.timer(player.shoot_timer, entries)
+
+    restore_worms(game.regions, data, entries)
+    restore_swarm(game.bee_swarm, data, entries)
+
+    for bullet in game.bullet_sprites.sprites():
+        bullet.kill()
+    for _ in range(int(data.next())):
+        x, y, direction, distance = data.take(4)
+        bullet = game.bullet_pool.acquire(game.bullet_frames, (x, y), int(direction))
+        bullet.distance = distance
+    particles = game.particles
+    particles.emitted = int(data.next())
+    for name in PARTICLE_ARRAYS:
+        values = data.array()
+        getattr(particles, name)[:len(values)] = values
+    particles.count = len(values)
+
+    # The clock and queue are set last, once every timer is back in the state it was in
+    heapify(entries)
+    scheduler = game.scheduler
+    scheduler.now, scheduler.sequence, scheduler.queue = now, int(sequence), entries
+    # Nothing to interpolate from, and sprites that moved have to be filed into their new render rows
+    for sprite in game.all_sprites:
+        sprite.previous_pos = None
+    game.all_sprites.render_queue.refresh()
+
+def restore_worms(regions, data, entries):
+    regions.active = {tuple(int(value) for value in key) for key in data.array().reshape(-1, 2).tolist()}
+    regions.pending, regions.suspended, regions.entities = {}, {}, []
+    for spawn in range(int(data.next())):
+        pos, area = regions.spawns[spawn]
+        state = data.next()
+        if state == PENDING:
+            # Spawned after the snapshot was taken, so it goes back to waiting for its region
+            for sprite, groups in regions.spawned.pop(spawn, ()):
+                sprite.kill()
+            regions.pending.setdefault(regions.key(pos), []).append(spawn)
+            continue
+        if spawn not in regions.spawned:
+            regions.spawned[spawn] = [(sprite, sprite.groups()) for sprite in regions.spawn_worm(pos, area)]
+        states = (state, *data.take(3))
+        worm = regions.spawned[spawn][1][0]
+        hitbox_x, hitbox_y, x, y, dir_x, dir_y, worm.frame_index, flip, worm.animation_speed = data.take(9)
+        worm.rect_hitbox.topleft = (hitbox_x, hitbox_y)
+        worm.rect.topleft = (x, y)
+        worm.worm_dir.update(dir_x, dir_y)
+        worm.flip = bool(flip)
+        data.timer(worm.death_timer, entries)
+        if worm.death_timer:
+            worm.image = worm.frames.silhouettes[worm.flip][int(worm.frame_index) % len(worm.frames)]
+        else:
+            worm.set_frame()
+
+        for (sprite, groups), state, suspended_at in zip(regions.spawned[spawn], states[::2], states[1::2]):
+            if state == MATERIALIZED:
+                sprite.add(*groups)
+                regions.entities.append(sprite)
+                continue
+            sprite.kill()
+            if state == SUSPENDED:
+                regions.suspended.setdefault(regions.key(sprite.rect.center), []).append((sprite, groups, suspended_at))
+
+def restore_swarm(swarm, data, entries):
+    # Every bee sprite goes back to the pool, and the ones in the snapshot are taken out again
+    for index in np.flatnonzero(swarm.has_sprite).tolist():
+        swarm.detach(index)
+    swarm.free_slots = [int(index) for index in data.array()]
+    for name in SWARM_ARRAYS:
+        setattr(swarm, name, data.array().astype(getattr(swarm, name).dtype))
+    swarm.sprites = [None] * len(swarm.x)
+    for index in np.flatnonzero(swarm.has_sprite).tolist():
+        bee = swarm.sprites[index] = swarm.pool.acquire(swarm.frames, swarm, index)
+        # A dying bee stays where it was hit, so its rect is not always where the swarm has it
+        x, y, bee.frame_index, flip, bee.animation_speed = data.take(5)
+        bee.rect.topleft = (x, y)
+        bee.flip = bool(flip)
+        data.timer(bee.death_timer, entries)
+        if bee.death_timer:
+            bee.image = bee.frames.silhouettes[bee.flip][int(bee.frame_index) % len(bee.frames)]
+        else:
+            bee.set_frame()
+
+class SnapshotRing:
+    '''The most recent snapshots, the oldest one is dropped once capacity is reached'''
+    def __init__(self, capacity: int):
+        self.snapshots = [None] * capacity
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def push(self, snapshot: np.ndarray):
+        self.snapshots[self.head] = snapshot
+        self.head = (self.head + 1) % len(self.snapshots)
+        self.count = min(self.count + 1, len(self.snapshots))
+
+    def back(self, steps: int = 0) -> np.ndarray:
+        '''The snapshot pushed steps pushes before the latest one, or the oldest one left'''
+        steps = min(steps, self.count - 1)
+        return self.snapshots[(self.head - 1 - steps) % len(self.snapshots)]
+
+    def pop(self) -> np.ndarray:
+        '''Takes the latest snapshot off, for rewinding one step at a time'''
+        snapshot = self.back()
+        self.head = (self.head - 1) % len(self.snapshots)
+        self.count -= 1
+        self.snapshots[self.head] = None
+        return snapshot
+
+    def clear(self):
+        self.snapshots = [None] * len(self.snapshots)
+        self.head = self.count = 0
@@ -1,32 +1,28 @@
-from setup import DISPLAY_WIDTH, DISPLAY_HEIGHT, DEBUG, TILE_SIZE
+from setup import DISPLAY_WIDTH, DISPLAY_HEIGHT, DEBUG, TILE_SIZE, LAYERS
 from settings import *
 from assets import *
 from timerclass import Timer
-from math import sin
-from random import randint
+from tilegrid import TileLayer
 
 # Sprite properties _________________________________________________________________________________________________________________________________________________________________
 
 class Sprite(pg.sprite.Sprite):
-    def __init__(self, surf, pos: tuple, *groups):
-        super().__init__(*groups)
-        self.image = surf
-        self.rect = self.image.get_frect(topleft = pos)
-        self.ground = True
-
+    render_layer = LAYERS['ground']
 
-
-class CollisionSprite(pg.sprite.Sprite):
-    def __init__(self, pos: tuple, surf, groups):
-        super().__init__(groups)
+    def __init__(self, surf, pos: tuple, *groups):
+        super().__init__()
         self.image = surf
         self.rect = self.image.get_frect(topleft = pos)
+        # Groups are joined once the rect exists, since AllSprites files sprites by their position
+        self.add(*groups)
 
 
 
 class TransparentSprite(pg.sprite.Sprite):
+    render_layer = LAYERS['decoration']
+
     def __init__(self, pos: tuple, length: float, width: float, *groups, RGB: tuple, debug):
-        super().__init__(*groups)
+        super().__init__()
         self.image = pg.Surface((length, width), pg.SRCALPHA)
         # Transparent fill for debugging, otherwise set alpha to 0
         self.debug = debug
@@ -34,66 +30,108 @@ class TransparentSprite(pg.sprite.Sprite):
             self.image.fill((RGB))
             self.image.set_alpha(100) 
         self.rect = self.image.get_frect(topleft = pos)
+        self.add(*groups)
 
 
 
 class AnimatedSprite(Sprite):
-    def __init__(self, frames: list , pos: tuple, *groups):
+    render_layer = LAYERS['entities']
+
+    def __init__(self, frames: FrameCache, pos: tuple, *groups):
         self.frames, self.frame_index, self.animation_speed = frames, 0, 0
-        super().__init__(self.frames[self.frame_index], pos, *groups)
+        self.flip = False
+        super().__init__(self.frames.images[0][0], pos, *groups)
+        self.mask = self.frames.masks[0][0]
+
+    def set_frame(self):
+        # Frames and masks come prebuilt from the frame cache, so this is only an index lookup
+        index = int(self.frame_index) % len(self.frames)
+        self.image = self.frames.images[self.flip][index]
+        self.mask = self.frames.masks[self.flip][index]
 
     def animate(self, dt):
         self.frame_index += self.animation_speed * dt
-        self.image = self.frames[int(self.frame_index) % len(self.frames)]
-        self.image = pg.transform.flip(self.image, self.flip, False)
+        self.set_frame()
+
+
+class Pool:
+    '''
+    Keeps killed sprites around so they can be reused instead of allocating new ones. acquire() takes
+    the same arguments as the sprite's constructor: a free sprite is reset() with them, otherwise a new
+    one is created, and either way it is (re)added to the pool's groups.
+    '''
+    def __init__(self, sprite_class, *groups):
+        self.sprite_class = sprite_class
+        self.groups = groups
+        self.free = []
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self, *args, **kwargs):
+        if self.free:
+            sprite = self.free.pop()
+            sprite.reset(*args, **kwargs)
+            self.reused += 1
+        else:
+            sprite = self.sprite_class(*args, **kwargs)
+            sprite.pool = self
+            self.created += 1
+        sprite.add(*self.groups)
+        return sprite
 
-# Sprite Classes __________________________________________________________________________________________________________________________________
+    def release(self, sprite):
+        self.free.append(sprite)
 
+    def stats(self) -> dict:
+        return {'created': self.created, 'reused': self.reused, 'free': len(self.free),
+                'active': self.created - len(self.free)}
 
-class Bullet(Sprite):
-    def __init__(self, surf, pos, direction, *groups):
-        super().__init__(surf, pos, *groups)
 
-        # Movement attributes
-        self.bullet_dir = direction
-        self.bullet_speed = 1200
 
-    def update(self,dt):
-        self.rect.x += self.bullet_dir * self.bullet_speed * dt
+class Pooled:
+    '''Mixin for sprites handed out by a Pool, killing them returns them to it'''
+    pool = None
 
+    def kill(self):
+        # Only a live sprite goes back, so killing one twice can't put it in the pool twice
+        alive = self.alive()
+        super().kill()
+        if alive and self.pool:
+            self.pool.release(self)
 
+# Sprite Classes __________________________________________________________________________________________________________________________________
 
-class Fire(Sprite):
-    def __init__(self, surf, pos, player, *groups):
-        super().__init__(surf, pos, *groups)
-        self.player = player
-        self.flip = player.flip
-        self.timer = Timer(100, autostart = True, func=self.kill)
-        # Properly fit the animation to the barrel
-        self.offset_y = pg.Vector2(0,9)
 
-        if self.player.flip:
-            self.rect.midright = self.player.rect.midleft + self.offset_y
-            self.image = pg.transform.flip(self.image, True, False)
-        else:
-            self.rect.midleft = self.player.rect.midright + self.offset_y
+class Bullet(Pooled, Sprite):
+    render_layer = LAYERS['projectiles']
 
-    def update(self, _):
-        self.timer.update()
+    def __init__(self, frames, pos, direction, *groups):
+        super().__init__(frames.images[0][0], pos, *groups)
+        self.mask = frames.masks[0][0]
 
-        if self.player.flip:
-            self.rect.midright = self.player.rect.midleft + self.offset_y
-        else:
-            self.rect.midleft = self.player.rect.midright + self.offset_y
-        
-        if self.flip != self.player.flip:
+        # Movement attributes
+        self.bullet_dir = direction
+        self.bullet_speed = 1200
+        # Bullets that hit nothing are removed after travelling this far
+        self.bullet_range = DISPLAY_WIDTH * 2
+        self.distance = 0
+
+    def reset(self, frames, pos, direction):
+        self.rect.topleft = pos
+        self.bullet_dir = direction
+        self.distance = 0
+
+    def update(self,dt):
+        self.rect.x += self.bullet_dir * self.bullet_speed * dt
+        self.distance += self.bullet_speed * dt
+        if self.distance >= self.bullet_range:
             self.kill()
 
 
 
 '''Handles all the controls and movement logic for the player'''
 class Player(AnimatedSprite):
-    def __init__(self, frames, pos, clock, create_bullet, collision_sprites, *groups):
+    def __init__(self, frames, pos, create_bullet, tile_grid, controls, scheduler, *groups):
         super().__init__(frames, pos, *groups)
 
         # Animation/rect attributes
@@ -122,21 +160,23 @@ class Player(AnimatedSprite):
         self.hangtime_timer = 0
         self.in_hangtime = False;
 
-        self.collision_sprites = collision_sprites
+        self.tile_grid = tile_grid
         self.jump_start = self.rect.copy()
 
-        self.clock = clock
+        # Input source, called once per step for the current Controls
+        self.controls = controls
 
         # Timer
-        self.shoot_timer = Timer(500)
+        self.scheduler = scheduler
+        self.shoot_timer = Timer(scheduler, 500)
         
 
     def input(self):
-        self.keys = pg.key.get_pressed()
+        controls = self.controls()
         # Movement vector
-        self.player_dir.x = int(self.keys[pg.K_d]) - int(self.keys[pg.K_a]) # Both return boolean values
+        self.player_dir.x = int(controls.right) - int(controls.left) # Both are boolean values
         # Jump 
-        if self.keys[pg.K_SPACE]:
+        if controls.jump:
             if self.on_floor and not self.jump_pressed:
                 self.jumping = True
                 self.jump_timer = 0
@@ -147,18 +187,16 @@ class Player(AnimatedSprite):
             self.jumping = False      
             self.player_velocity = 450
         
-        self.mouse = pg.mouse.get_just_pressed()
-        if (self.mouse[0] or self.keys[pg.K_LEFT] or self.keys[pg.K_RIGHT]) and not self.shoot_timer:
+        if controls.shoot and not self.shoot_timer:
             shoot_bullet_sound()
             self.create_bullet(self.rect.center, -1 if self.flip else 1)
             self.shoot_timer.activate()
 
 
-    def movement(self, dt, clock):
+    def movement(self, dt):
         '''
-        We divide 1020 by the current FPS to find px/frame. 1020 is a good px/s rate for the jump velocity. 
-        Thus, dividing by the FPS, we get some px/frame rate that makes the velocity consistent
-        over all frame rates.
+        We multiply 1020 by the step time to find px/step. 1020 is a good px/s rate for the jump velocity.
+        The simulation runs at a fixed step (SIM_DT), so this stays the same no matter the render rate.
         '''
 
         # Displacement storage
@@ -168,7 +206,7 @@ class Player(AnimatedSprite):
 
         if self.jumping:
             # Frame independence logic
-            self.jump_velocity_PPF  = self.jump_velocity_PPS / self.clock.get_fps()
+            self.jump_velocity_PPF  = self.jump_velocity_PPS * dt
             self.player_dir.y -= self.jump_velocity_PPF 
         
             jump_displacement = self.jump_start_y - self.rect.centery
@@ -197,47 +235,48 @@ class Player(AnimatedSprite):
 
 
         # Horizontal movement and collision
-        self.rect_hitbox.x += self.player_dir.x * self.player_speed * dt
-        self.collision('horizontal')
+        self.collision('horizontal', self.player_dir.x * self.player_speed * dt)
 
         # Apply gravity
         if not self.in_hangtime:
             self.player_dir.y += self.player_gravity * 4 * dt
-            self.rect_hitbox.y += self.player_dir.y
-            self.collision('vertical')
+            self.collision('vertical', self.player_dir.y)
 
         self.rect.center = self.rect_hitbox.center
 
-    def collision(self, direction):
+    def collision(self, direction, distance):
         '''Handles all of object collision logic'''
 
-        # Iterate over all collision sprites each frame to check for collisions
-        for sprite in self.collision_sprites:
-            # Returns True if any part of the two rects overlap (player and object), including edges
-            # However, it does NOT determine which side the collision occurs on—only that an overlap exists
-            if sprite.rect.colliderect(self.rect_hitbox):
-
-                if direction == 'horizontal':
-                     # If the player is moving right (positive velocity), snap their right side to the object's left side
-                    if self.player_dir.x > 0: self.rect_hitbox.right = sprite.rect.left
-                    # And vice-versa
-                    if self.player_dir.x < 0: self.rect_hitbox.left = sprite.rect.right
-                if direction == 'vertical': 
-                     # If the player is moving up (negative velocity), snap their top side to the object's bottom side
-                    if self.player_dir.y < 0: self.rect_hitbox.top = sprite.rect.bottom
-                    if self.player_dir.y > 0: self.rect_hitbox.bottom = sprite.rect.top
-                    
-                    self.player_dir.y = 0
+        # The tile grid sweeps the hitbox along one axis and snaps it against the first solid cell in
+        # its path, so we only check the few cells the hitbox passes over instead of every tile
+        if direction == 'horizontal':
+            # If the player is moving right (positive velocity), their right side is snapped to the tile's left side
+            # And vice-versa
+            self.tile_grid.move_x(self.rect_hitbox, distance)
+        if direction == 'vertical':
+            # If the player is moving up (negative velocity), their top side is snapped to the tile's bottom side
+            if self.tile_grid.move_y(self.rect_hitbox, distance):
+                self.player_dir.y = 0
+
+    def respawn(self, pos, tile_grid):
+        '''Moves the player to the start of a new level, standing still'''
+        self.player_start_pos = pos
+        self.tile_grid = tile_grid
+        self.rect.topleft = pos
+        self.rect_hitbox = self.rect.inflate(-20,0)
+        self.player_dir.update(0, 0)
+        self.jumping = self.in_hangtime = False
+        # Nothing to interpolate from, the player didn't travel here
+        self.previous_pos = None
 
     def check_floor(self):
         '''
-        We create a small rect at the bottom of the player which checks for collisions with objects
+        We create a small rect at the bottom of the player which checks for collisions with the tile grid
         '''
         bottom_rect = self.rect_hitbox.copy()
         bottom_rect.height = 2
         bottom_rect.top = self.rect_hitbox.bottom
-        # any() returns True if at least one value in an iterable is True
-        self.on_floor = any(bottom_rect.colliderect(sprite.rect) for sprite in self.collision_sprites)
+        self.on_floor = self.tile_grid.overlaps(bottom_rect)
 
     def animate(self, dt):
         if self.player_dir.x:
@@ -250,15 +289,13 @@ class Player(AnimatedSprite):
         if not self.on_floor:
             self.frame_index = 1
 
-        self.image = self.frames[int(self.frame_index) % len(self.frames)]
-        self.image = pg.transform.flip(self.image, self.flip, False)
+        self.set_frame()
 
 
     def update(self, dt):
-        self.shoot_timer.update()
         self.check_floor()
         self.input()
-        self.movement(dt, self.clock)
+        self.movement(dt)
         self.animate(dt)
 
         # Normalize the player velocity vector for diagonal movement
@@ -268,19 +305,17 @@ class Player(AnimatedSprite):
 
 
 class Enemy(AnimatedSprite):
-    def __init__(self, frames, pos, *groups):
+    def __init__(self, frames, pos, scheduler, *groups):
         super().__init__(frames, pos, *groups)            
-        self.death_timer = Timer(200, func= self.kill)
+        self.death_timer = Timer(scheduler, 200, func= self.kill)
  
 
     def destroy(self):
         self.death_timer.activate()
         self.animation_speed = 0
-        self.image = pg.mask.from_surface(self.image).to_surface()
-        self.image.set_colorkey('black')
+        self.image = self.frames.silhouettes[self.flip][int(self.frame_index) % len(self.frames)]
 
     def update(self, dt):
-        self.death_timer.update()
         if not self.death_timer:
             self.movement(dt)
             self.animate(dt)
@@ -289,10 +324,11 @@ class Enemy(AnimatedSprite):
 
 
 class Worm(Enemy):
-    def __init__(self, frames, pos, area, collision_sprites, *groups):
-            super().__init__(frames, pos, *groups)
+    def __init__(self, frames, pos, area, platforms, scheduler, *groups):
+            super().__init__(frames, pos, scheduler, *groups)
 
-            self.collision_sprites = collision_sprites
+            self.platforms = platforms
+            self.tile_grid = platforms.grid
 
             # Animation states
             self.animation_speed = 6
@@ -303,72 +339,118 @@ class Worm(Enemy):
             self.worm_dir = pg.Vector2(1,0)
             self.worm_area = area
             self.flip = self.worm_dir.x < 0
+            self.land()
 
+    def land(self):
+        '''
+        Puts the worm on the platform under it and picks the span it patrols: the platform, narrowed to the
+        spawn area where one overlaps it. A worm with no platform under it keeps falling until it has one.
+        '''
+        self.platform = self.platforms.platform_at((self.rect_hitbox.centerx, self.rect_hitbox.bottom), self.gravity)
+        if self.platform is None:
+            return
+        self.rect_hitbox.bottom = self.platform.top
+        width = self.rect_hitbox.width
+        low, high = self.platform.left, self.platform.right - width
+        if self.worm_area is not None:
+            # The worm used to turn once its hitbox stopped overlapping the shrunk area
+            shrunk_rect = self.worm_area.rect.inflate(-40,-40)
+            if shrunk_rect.left - width < high and shrunk_rect.right > low:
+                low, high = max(low, shrunk_rect.left - width), min(high, shrunk_rect.right)
+        self.patrol_span = (low, max(low, high))
+        self.rect_hitbox.left = min(max(self.rect_hitbox.left, low), max(low, high))
+        self.rect.center = self.rect_hitbox.center
 
-    def movement(self, dt): 
-        self.rect_hitbox.x += self.speed * self.worm_dir.x * dt
-        self.rect_hitbox.y += self.gravity
-        self.worm_dir.y += self.gravity
-        self.collision()
-
+    def patrol(self, distance):
+        '''
+        Walks the worm distance further along its patrol. It walks back and forth over a fixed span, and
+        unfolding those bounces into one line turns the patrol into a modulo, so this takes the same time
+        for one step as for a worm fast forwarded by minutes.
+        '''
+        low, high = self.patrol_span
+        span = high - low
+        if span <= 0:
+            return
+        travelled = self.rect_hitbox.left - low
+        if self.worm_dir.x < 0:
+            travelled = 2 * span - travelled
+        travelled = (travelled + distance) % (2 * span)
+        self.worm_dir.x = 1 if travelled < span else -1
+        self.rect_hitbox.left = low + (travelled if travelled < span else 2 * span - travelled)
 
+    def movement(self, dt): 
+        if self.platform:
+            self.patrol(self.speed * dt)
+        elif self.tile_grid.move_y(self.rect_hitbox, self.gravity):
+            self.land()
         self.rect.center = self.rect_hitbox.center
 
     def constraint(self):
-        shrunk_rect = self.worm_area.rect.inflate(-40,-40)  # Fixes finicky behavior
-        if not shrunk_rect.colliderect(self.rect_hitbox):
-            self.worm_dir.x *= -1
-
-    def collision(self):
-
-        for sprite in self.collision_sprites:
-                if sprite.rect.colliderect(self.rect_hitbox):
+        # The patrol never leaves the platform
+        pass
 
-                    if self.worm_dir.y > 0: self.rect_hitbox.bottom = sprite.rect.top
+    def fast_forward(self, elapsed):
+        '''Puts a worm that was suspended for elapsed seconds where its patrol would have taken it'''
+        if self.platform:
+            self.patrol(self.speed * elapsed)
+            self.rect.center = self.rect_hitbox.center
+        self.frame_index += self.animation_speed * elapsed
+        self.animate(0)
 
     def animate(self, dt):
         self.frame_index += self.animation_speed * dt
         self.flip = self.worm_dir.x < 0
-        self.image = self.frames[int(self.frame_index) % len(self.frames)]
-        self.image = pg.transform.flip(self.image, self.flip, False)
+        self.set_frame()
 
 
 
-class Bee(Enemy):
-    def __init__(self, frames, pos, groups, speed):
-        super().__init__(frames, pos, groups)
+class Bee(Pooled, Enemy):
+    '''
+    A bee near the camera. The bee itself is an entry in the BeeSwarm, which moves every bee and its sprite
+    at once, and the sprite is handed back to the pool when the bee leaves the camera.
+    '''
+    def __init__(self, frames, swarm, index, *groups):
+        super().__init__(frames, swarm.position(index), swarm.scheduler, *groups)
+        self.reset(frames, swarm, index)
+
+    def reset(self, frames, swarm, index):
+        self.swarm = swarm
+        self.swarm_index = index
         self.flip = False
-        self.speed = speed
+        self.frame_index = 0
+        self.set_frame()
+        self.rect.topleft = swarm.position(index)
+        self.death_timer.cancel()
         self.animation_speed = 8
-        self.amplitude = randint(500,600)
-        self.frequency = randint(300,600)
 
     def movement(self, dt):
-        self.rect.x -= self.speed * dt
-        # Bees move in a sinusodial path
-        self.rect.y += sin(pg.time.get_ticks() / self.frequency) * self.amplitude * dt
+        # Moved by the swarm
+        pass
 
     def constraint(self):
-        # When the bees go way off screen
-        if self.rect.right <= -1500:
-            self.kill()
+        # The swarm removes the bees that go way off screen
+        pass
+
+    def destroy(self):
+        super().destroy()
+        self.swarm.dying[self.swarm_index] = True
+
+    def kill(self):
+        # Killed as an enemy, rather than detached by the swarm, so the bee itself is gone too
+        if self.swarm_index is not None:
+            self.swarm.remove(self.swarm_index)
+            self.swarm_index = None
+        super().kill()
 
   
 
 # LOADING SPRITE ASSETS ___________________________________________________________________________________________________________________________________________________________________________________________________________
 
 def ground(self):
-    for x,y, image in self.map.get_layer_by_name('Main').tiles():
-        Sprite(image, (x * TILE_SIZE ,y * TILE_SIZE ), (self.all_sprites, self.collision_sprites))
-
-def objects(self):
-    for x,y, image in self.map.get_layer_by_name('Decoration').tiles():
-        Sprite(image, (x * TILE_SIZE ,y * TILE_SIZE ), self.all_sprites)
+    # Tiles stay as ids in their layers. Main is also what the player and the worms collide with
+    self.tile_layers = {name: TileLayer(self.map.layer(name), self.map.tile_images) for name in ('Main', 'Decoration')}
+    self.tile_grid = self.tile_layers['Main']
 
 def collision(self):
-    self.worm_spawn_area = []
-    for col in self.map.get_layer_by_name('Entities'):
-        if col.name == 'Worm':
-            self.worm_spawn_area.append(TransparentSprite((col.x, col.y), col.width, col.height, 
-                                                self.all_sprites, RGB=(255,0,0), debug=DEBUG))
-    
+    # Only the map objects, the worms and their areas are made when their region is materialized
+    self.worm_spawn_area = [col for col in self.map.objects('Entities') if col.name == 'Worm']
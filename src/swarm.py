@@ -0,0 +1,116 @@
+from setup import *
+import numpy as np
+
+'''
+Every bee lives as one entry in the swarm's NumPy arrays, and the whole swarm is moved in one vectorized
+step. Only bees near the camera are materialized as Bee sprites (from the bee pool), so the renderer and
+the collision system only ever see those. The swarm moves those sprites along with their entries, and
+a Bee sprite hands its entry back when killed.
+'''
+class BeeSwarm:
+    def __init__(self, frames, pool, scheduler, capacity = 256):
+        self.frames = frames
+        self.pool = pool
+        # Handed to the Bee sprites for their death timers
+        self.scheduler = scheduler
+        self.width, self.height = frames.images[0][0].get_size()
+        self.x = np.zeros(capacity)
+        self.y = np.zeros(capacity)
+        self.speed = np.zeros(capacity)
+        self.amplitude = np.zeros(capacity)
+        self.frequency = np.ones(capacity)
+        # Simulation time in ms of every bee, which drives its sine wave
+        self.time = np.zeros(capacity)
+        self.alive = np.zeros(capacity, dtype=bool)
+        # Destroyed bees stand still while their sprite flashes
+        self.dying = np.zeros(capacity, dtype=bool)
+        self.has_sprite = np.zeros(capacity, dtype=bool)
+        self.sprites = [None] * capacity
+        self.free_slots = list(range(capacity - 1, -1, -1))
+
+    def __len__(self):
+        return int(np.count_nonzero(self.alive))
+
+    def grow(self):
+        capacity = len(self.x)
+        for name in ('x', 'y', 'speed', 'amplitude', 'frequency', 'time', 'alive', 'dying', 'has_sprite'):
+            array = getattr(self, name)
+            grown = np.ones(capacity * 2, dtype=array.dtype) if name == 'frequency' else np.zeros(capacity * 2, dtype=array.dtype)
+            grown[:capacity] = array
+            setattr(self, name, grown)
+        self.sprites.extend([None] * capacity)
+        self.free_slots.extend(range(capacity * 2 - 1, capacity - 1, -1))
+
+    def spawn(self, pos, speed, amplitude, frequency, time) -> int:
+        if not self.free_slots:
+            self.grow()
+        index = self.free_slots.pop()
+        self.x[index], self.y[index] = pos
+        self.speed[index] = speed
+        self.amplitude[index] = amplitude
+        self.frequency[index] = frequency
+        self.time[index] = time
+        self.alive[index] = True
+        self.dying[index] = False
+        return index
+
+    def position(self, index) -> tuple:
+        return float(self.x[index]), float(self.y[index])
+
+    def remove(self, index):
+        self.alive[index] = False
+        self.dying[index] = False
+        self.has_sprite[index] = False
+        self.sprites[index] = None
+        self.free_slots.append(index)
+
+    def detach(self, index):
+        '''Returns the bee's sprite to the pool without removing the bee itself'''
+        sprite = self.sprites[index]
+        self.sprites[index] = None
+        self.has_sprite[index] = False
+        sprite.swarm_index = None
+        sprite.kill()
+
+    def clear(self):
+        '''Removes every bee, their sprites go back to the pool'''
+        for index in np.flatnonzero(self.has_sprite).tolist():
+            self.detach(index)
+        for index in np.flatnonzero(self.alive).tolist():
+            self.remove(index)
+
+    def update(self, dt, center):
+        moving = self.alive & ~self.dying
+        self.x -= self.speed * (dt * moving)
+        self.time += 1000 * dt * moving
+        # Bees move in a sinusodial path
+        self.y += np.sin(self.time / self.frequency) * self.amplitude * (dt * moving)
+
+        # When the bees go way off screen
+        for index in np.flatnonzero(self.alive & (self.x + self.width <= -1500)).tolist():
+            if self.has_sprite[index]:
+                self.detach(index)
+            self.remove(index)
+
+        # Materialize the bees around the camera, with a margin so bullets still meet them off screen
+        margin_x, margin_y = SWARM_ACTIVE_MARGIN
+        left = center[0] - DISPLAY_WIDTH / 2 - margin_x
+        right = center[0] + DISPLAY_WIDTH / 2 + margin_x
+        top = center[1] - DISPLAY_HEIGHT / 2 - margin_y
+        bottom = center[1] + DISPLAY_HEIGHT / 2 + margin_y
+        active = self.alive & (self.x + self.width > left) & (self.x < right) & (self.y + self.height > top) & (self.y < bottom)
+
+        for index in np.flatnonzero(self.has_sprite & ~active).tolist():
+            dying = self.dying[index]
+            self.detach(index)
+            # A dying bee would never finish its death without a sprite
+            if dying:
+                self.remove(index)
+        # Sprites are moved in one pass here, after AllSprites stored their previous positions
+        following = np.flatnonzero(self.has_sprite & ~self.dying)
+        for index, x, y in zip(following.tolist(), self.x[following].tolist(), self.y[following].tolist()):
+            self.sprites[index].rect.topleft = (x, y)
+
+        for index in np.flatnonzero(active & ~self.has_sprite).tolist():
+            self.sprites[index] = self.pool.acquire(self.frames, self, index)
+            self.has_sprite[index] = True
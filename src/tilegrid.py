@@ -0,0 +1,113 @@
+from setup import *
+from array import array
+import numpy as np
+from math import ceil
+
+'''
+The tile grid is a flat occupancy array built from the Main layer of the tile map. Instead of testing
+a hitbox against every collision sprite, we only look at the handful of cells the hitbox covers.
+Cells outside of the map are always treated as empty so the player can still fall off the map.
+'''
+class TileGrid:
+    def __init__(self, ids, tile_size: int = TILE_SIZE):
+        '''Builds the grid from a 2D array of tile ids, where every non zero id is solid'''
+        self.height, self.width = ids.shape
+        self.tile_size = tile_size
+        # One byte per cell, row-major: 1 is solid, 0 is empty
+        self.cells = array('B', (ids != 0).astype('uint8').tobytes())
+
+    def is_solid(self, col: int, row: int) -> bool:
+        if 0 <= col < self.width and 0 <= row < self.height:
+            return bool(self.cells[row * self.width + col])
+        return False
+
+    def cols(self, rect) -> range:
+        # Columns the rect overlaps. Touching edges do not count as an overlap, same as colliderect
+        return range(int(rect.left // self.tile_size), ceil(rect.right / self.tile_size))
+
+    def rows(self, rect) -> range:
+        return range(int(rect.top // self.tile_size), ceil(rect.bottom / self.tile_size))
+
+    def overlaps(self, rect) -> bool:
+        '''Returns True if any solid cell overlaps the rect'''
+        for row in self.rows(rect):
+            for col in self.cols(rect):
+                if self.is_solid(col, row):
+                    return True
+        return False
+
+    def move_x(self, rect, dx: float) -> bool:
+        '''
+        Swept movement along the x axis. Every column between the start and end position of the
+        leading edge is checked in order, so fast moving rects stop at the first solid cell instead
+        of tunneling through it. Returns True if the rect was stopped by a cell.
+        '''
+        if dx == 0:
+            return False
+        size = self.tile_size
+        rows = self.rows(rect)
+        if dx > 0:
+            end = rect.right + dx
+            for col in range(int(rect.right // size), ceil(end / size)):
+                if any(self.is_solid(col, row) for row in rows):
+                    rect.right = col * size
+                    return True
+        else:
+            end = rect.left + dx
+            for col in range(ceil(rect.left / size) - 1, int(end // size) - 1, -1):
+                if any(self.is_solid(col, row) for row in rows):
+                    rect.left = (col + 1) * size
+                    return True
+        rect.x += dx
+        return False
+
+    def move_y(self, rect, dy: float) -> bool:
+        '''Swept movement along the y axis, see move_x'''
+        if dy == 0:
+            return False
+        size = self.tile_size
+        cols = self.cols(rect)
+        if dy > 0:
+            end = rect.bottom + dy
+            for row in range(int(rect.bottom // size), ceil(end / size)):
+                if any(self.is_solid(col, row) for col in cols):
+                    rect.bottom = row * size
+                    return True
+        else:
+            end = rect.top + dy
+            for row in range(ceil(rect.top / size) - 1, int(end // size) - 1, -1):
+                if any(self.is_solid(col, row) for col in cols):
+                    rect.top = (row + 1) * size
+                    return True
+        rect.y += dy
+        return False
+
+
+class TileLayer(TileGrid):
+    '''
+    A tile layer of the map, kept as data instead of one Sprite per tile: the tile ids in a compact 2D
+    array, and the tile images of the atlas they index into, which every layer of a map shares. The
+    layer answers collision queries as a TileGrid, where every tile is solid, and render queries with
+    tiles(), which hands back a blit sequence for the tiles inside a rect.
+    '''
+    def __init__(self, ids, tile_images: list, tile_size: int = TILE_SIZE):
+        super().__init__(ids, tile_size)
+        self.ids = ids
+        # Index 0 is the empty tile
+        self.tile_images = tile_images
+
+    def tile(self, col: int, row: int) -> int:
+        if 0 <= col < self.width and 0 <= row < self.height:
+            return int(self.ids[row, col])
+        return 0
+
+    def tiles(self, rect, offset = (0, 0)) -> list:
+        '''(image, position) of every tile overlapping the rect, moved by offset, ready for fblits'''
+        size = self.tile_size
+        cols, rows = self.cols(rect), self.rows(rect)
+        left, top = max(0, cols.start), max(0, rows.start)
+        ids = self.ids[top:max(top, rows.stop), left:max(left, cols.stop)]
+        found_rows, found_cols = np.nonzero(ids)
+        images = self.tile_images
+        return [(images[tile], ((left + x) * size + offset[0], (top + y) * size + offset[1]))
+                for x, y, tile in zip(found_cols.tolist(), found_rows.tolist(), ids[found_rows, found_cols].tolist())]
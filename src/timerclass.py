@@ -1,17 +1,48 @@
 from setup import *
+from heapq import heappush, heappop
 
 '''
-Since the included time module within pygame breaks the game when used within the game loop,
-we use a seperate timer class, which we can add functions that activate at the end of the duration,
-and configurate whether the timer repeats, or autostarts.
+Timers run on simulation time rather than the wall clock, so they behave the same under the fixed step,
+headless games and replays. Every timer is registered with the Scheduler owned by the Game when it is
+activated, and the scheduler keeps the due times in a binary heap, so each step only the timers that are
+actually due get looked at, no matter how many are running.
 '''
+class Scheduler:
+    def __init__(self):
+        self.now = 0    # Simulation time in ms
+        self.queue = []
+        # Breaks ties between timers due at the same time, so they fire in the order they were scheduled
+        self.sequence = 0
+
+    def schedule(self, timer, due):
+        self.sequence += 1
+        heappush(self.queue, (due, self.sequence, timer, timer.generation))
+
+    def advance(self, dt_ms):
+        '''Moves the clock forward and fires every timer that came due, in order'''
+        self.now += dt_ms
+        queue = self.queue
+        while queue and queue[0][0] <= self.now:
+            due, _, timer, generation = heappop(queue)
+            # Entries of timers that were cancelled or restarted since are skipped
+            if timer.active and timer.generation == generation:
+                timer.fire(due)
+
+    def __len__(self):
+        return len(self.queue)
+
+
+
 class Timer:
-    def __init__(self, duration, func = None, repeat = None, autostart = False):
+    def __init__(self, scheduler, duration, func = None, repeat = None, autostart = False):
+        self.scheduler = scheduler
         self.duration = duration
         self.start_time = 0
         self.active = False
         self.func = func
         self.repeat = repeat
+        # Bumped on every (re)start or cancel, which invalidates the entry already in the scheduler
+        self.generation = 0
 
         if autostart:
             self.activate()
@@ -20,22 +51,29 @@ class Timer:
         # If the timer is active--True, else False
         return self.active
     
-    def activate(self):
+    def activate(self, start_time = None):
         self.active = True
-        self.start_time = pg.time.get_ticks()
+        self.start_time = self.scheduler.now if start_time is None else start_time
+        self.generation += 1
+        self.scheduler.schedule(self, self.start_time + self.duration)
 
-    def deactivate(self):
+    def cancel(self):
         self.active = False
         self.start_time = 0
+        self.generation += 1
+
+    def deactivate(self):
+        self.cancel()
         if self.repeat:
             self.activate()
 
-    def update(self):
+    def fire(self, due):
         ''' 
-        If the timer has ended, start the function, 
-        check every frame if func is not zero, else deactivate.
+        Called by the scheduler once the timer has ended. Repeating timers restart from the time they were
+        due rather than from now, so they don't drift by a fraction of a step every time they fire.
         '''
-        if pg.time.get_ticks() - self.start_time >= self.duration:
-            if self.func and self.start_time != 0:
-                self.func()
-            self.deactivate()
\ No newline at end of file
+        if self.func:
+            self.func()
+        self.cancel()
+        if self.repeat:
+            self.activate(due)